@@ -0,0 +1,312 @@
+#!/usr/bin/python
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import music
+
+# benchmark a synthetic competition through each stage of music.build
+# downloads, ffmpeg and eyed3 are replaced by local stubs so only our own code is timed
+
+BUILD_ARGS = ["--columnar", "--header-lengths", "--length-tolerance", "5", "--report-formats", "html,json,csv",
+              "--snapshot"]
+
+UNIVERSITIES = ["Mit", "Harvard", "Boston University", "Yale", "Cornell", "Dartmouth", "Princeton", "Brown",
+                "Boston College", "Northeastern", "Tufts", "Wellesley", "Amherst", "Williams", "Middlebury"]
+FIRST_NAMES = ["Alice", "Bob", "Carol", "David", "Emma", "Frank", "Grace", "Henry", "Isabel", "Jack", "Kate",
+               "Liam", "Maya", "Noah", "Olivia", "Peter", "Quinn", "Rose", "Sam", "Tess"]
+LAST_NAMES = ["Smith", "Jones", "White", "Brown", "Taylor", "Lee", "Walker", "Hall", "Young", "King", "Wright",
+              "Green", "Baker", "Adams", "Nelson", "Carter", "Mitchell", "Roberts", "Turner", "Phillips"]
+DUMMY_AUDIO = b"\0" * 1024
+
+
+##############
+# GENERATION #
+##############
+
+
+def entry_event_name(event):
+    # one of the music.event_aliases of the event, the way it appears in the entries spreadsheet
+    if event.category == "Short Program":
+        name = event.level + " Short Program"
+    elif event.category == "Freeskate":
+        name = event.level
+    elif event.category == "Solo Pattern Dance":
+        name = event.level + " Pattern Dance"
+    else:
+        name = event.name
+    if event.gender == "Male":
+        name += " (Male)"
+    return name
+
+
+def skater_name(i):
+    # unique for every i, so name lookups never collide
+    return (FIRST_NAMES[i % len(FIRST_NAMES)],
+            LAST_NAMES[(i // len(FIRST_NAMES)) % len(LAST_NAMES)] + str(i // (len(FIRST_NAMES) * len(LAST_NAMES))))
+
+
+def generate_competition(path, starts, seed=0):
+    random.seed(seed)
+    events = music.read_events()
+    by_category = {}
+    for event in events:
+        by_category.setdefault((event.category, event.gender), []).append(event)
+
+    entries = []
+    submissions = []
+    i = 0
+    while len(entries) < starts:
+        gender = random.choice(["Female", "Male"])
+        first_name, last_name = skater_name(i)
+        university = random.choice(UNIVERSITIES)
+        email = "skater{}@example.edu".format(i)
+        skater_events = [random.choice(by_category[("Freeskate", gender)])]
+        if random.random() < 0.5:
+            skater_events.append(random.choice(by_category[("Short Program", gender)]))
+        if random.random() < 0.3:
+            skater_events.append(random.choice(by_category[("Solo Free Dance", "")]))
+        if random.random() < 0.2:
+            skater_events.append(random.choice(by_category[("Solo Pattern Dance", "")]))
+        submission = {
+            "USFS Number": str(100000 + i),
+            "Skater Name": first_name + " " + last_name,
+            "Email Address": email,
+            "Notes for Announcer": "",
+        }
+        for event in skater_events:
+            entries.append((event, gender, str(100000 + i), first_name, last_name, email, university))
+            if event.has_submitted_music and random.random() < 0.9:
+                column = {"Freeskate": "Free Skate", "Short Program": "Short Program",
+                          "Solo Free Dance": "Free Dance"}[event.category]
+                submission[column + " Event"] = event.short_name
+                submission[column + " Music"] = "http://stub/{}/{}".format(i, column.replace(" ", "_"))
+        submissions.append(submission)
+        i += 1
+
+    with open(os.path.join(path, "entries.csv"), "w") as file_out:
+        writer = csv.writer(file_out)
+        writer.writerow(["Event", "Gender", "USF #", "First Name", "Last Name", "E-mail", "University"])
+        for event, gender, usfs_number, first_name, last_name, email, university in entries:
+            writer.writerow([entry_event_name(event), gender, usfs_number, first_name, last_name, email, university])
+
+    with open(os.path.join(path, "updated_entries.csv"), "w") as file_out:
+        writer = csv.writer(file_out)
+        writer.writerow(["Name", "University"])
+        for event in events:
+            rows = [entry for entry in entries if entry[0] is event]
+            if rows:
+                writer.writerow([entry_event_name(event), ""])
+                for event, gender, usfs_number, first_name, last_name, email, university in rows:
+                    writer.writerow([first_name + " " + last_name, university])
+
+    columns = ["Timestamp", "USFS Number", "Skater Name", "Email Address", "Notes for Announcer",
+               "Free Dance Event", "Free Dance Music", "Free Skate Event", "Free Skate Music",
+               "Short Program Event", "Short Program Music"]
+    with open(os.path.join(path, "input.csv"), "w") as file_out:
+        writer = csv.DictWriter(file_out, columns, restval="")
+        writer.writeheader()
+        writer.writerows(submissions)
+
+
+#########
+# STUBS #
+#########
+
+
+def stub_download_music(start, index, connections):
+    if start.music_submissions and not music.get_cached_music(start, index):
+        music_filename = str(start.last_music_submission().index) + "_" + start.music_key + ".mp3"
+        with open(os.path.join(music.directory, "music_raw", music_filename), "wb") as file_out:
+            file_out.write(DUMMY_AUDIO)
+        index.add(music_filename)
+
+
+def stub_transcode_music(transcode):
+    shutil.copyfile(transcode.input_path, transcode.output_path)
+    transcode.returncode = 0
+    return True
+
+
+def stub_tag_music(transcode):
+    pass
+
+
+def stub_read_metadata(path):
+    return {"duration": os.path.getsize(path) // 10, "version": 1, "title": None, "album": None}
+
+
+def install_stubs():
+    music.download_music = stub_download_music
+    music.transcode_music = stub_transcode_music
+    music.tag_music = stub_tag_music
+    music.read_metadata = stub_read_metadata
+
+
+##########
+# TIMING #
+##########
+
+
+def quietly(function, *args):
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            return function(*args)
+        finally:
+            sys.stdout = stdout
+
+
+class Timer(object):
+
+    def __init__(self):
+        self.stages = {}
+
+    def stage(self, name, function, *args):
+        began = time.time()
+        result = quietly(function, *args)
+        self.stages[name] = time.time() - began
+        return result
+
+
+def run_stages(timer):
+    # music.build_stages times its own stages in music.stats, the columnar build is then compared against the
+    # row by row counts and length checks, and the snapshot it saved is loaded back
+    args = music.parse_args(BUILD_ARGS)
+    music.stats.reset()
+    music.input_errors.reset()
+    events, skaters = quietly(music.build_stages, args)
+    for stage in music.stats.report()["stages"]:
+        timer.stages[stage["name"]] = stage["wall"]
+    starts = [start for event in events for start in event.starts]
+    table = music.StartTable(events)
+    timer.stage("print_counts_rows", music.print_counts, events, True)
+    timer.stage("print_counts_columnar", music.print_counts, events, True, table)
+    timer.stage("check_lengths_rows", music.check_lengths, starts, args.length_tolerance)
+    timer.stage("snapshot_load", music.ModelSnapshot().load)
+    return len(starts)
+
+
+def object_attributes(obj):
+    if hasattr(obj, "__dict__"):
+        return vars(obj).values()
+    return [getattr(obj, name) for name in type(obj).__slots__ if hasattr(obj, name)]
+
+
+def model_memory(objects):
+    # bytes held by the objects, their attribute dicts and the distinct strings and lists they reference
+    total = 0
+    seen = set()
+    for obj in objects:
+        total += sys.getsizeof(obj)
+        if hasattr(obj, "__dict__"):
+            total += sys.getsizeof(obj.__dict__)
+        for value in object_attributes(obj):
+            if isinstance(value, (str, list)) and id(value) not in seen:
+                seen.add(id(value))
+                total += sys.getsizeof(value)
+    return total
+
+
+def benchmark_models(scale):
+    # construct skaters and starts the way read_entries does, without any file parsing
+    events = [event for event in music.read_events() if event.category != "Team Maneuvers"]
+    rows = []
+    for i in range(scale):
+        first_name, last_name = skater_name(i // 2)
+        rows.append((events[i % len(events)], str(100000 + i // 2), first_name, last_name,
+                     "skater{}@example.edu".format(i // 2), " ".join([UNIVERSITIES[i % len(UNIVERSITIES)]])))
+    began = time.time()
+    skaters = {}
+    starts = []
+    for event, usfs_number, first_name, last_name, email, university in rows:
+        skater = skaters.get(usfs_number)
+        if not skater:
+            skater = skaters[usfs_number] = music.Skater(usfs_number, first_name, last_name, email)
+            skater.university = university
+        starts.append(music.Start(skater, event))
+    construct_seconds = time.time() - began
+    began = time.time()
+    for start in starts:
+        start.music_key
+    music_key_seconds = time.time() - began
+    return {
+        "starts": len(starts),
+        "construct": construct_seconds,
+        "music_key": music_key_seconds,
+        "memory": model_memory(starts) + model_memory(skaters.values()) + model_memory(events),
+    }
+
+
+def benchmark(scale, keep):
+    cwd = os.getcwd()
+    path = tempfile.mkdtemp(prefix="music-benchmark-")
+    try:
+        shutil.copy("events.csv", path)
+        shutil.copy("template.html", path)
+        os.chdir(path)
+        music.directory = os.path.join(path, "data")
+        os.makedirs(os.path.join(music.directory, "music"))
+        os.makedirs(os.path.join(music.directory, "music_raw"))
+        began = time.time()
+        generate_competition(music.directory, scale)
+        generate_seconds = time.time() - began
+        timer = Timer()
+        starts = run_stages(timer)
+        return {"starts": starts, "generate": generate_seconds, "stages": timer.stages,
+                "total": sum(timer.stages.values())}
+    finally:
+        os.chdir(cwd)
+        if keep:
+            print ("Kept benchmark data in", path)
+        else:
+            shutil.rmtree(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time each stage of music.py on synthetic competitions")
+    parser.add_argument("--scales", default="100,1000,10000,100000", help="comma separated numbers of starts")
+    parser.add_argument("--output", default="benchmark.json", help="where to write the results as JSON")
+    parser.add_argument("--keep", action="store_true", help="keep the generated competitions")
+    parser.add_argument("--models", action="store_true",
+                        help="only measure construction time and memory of the data model")
+    args = parser.parse_args()
+
+    if args.models:
+        results = {"python": platform.python_version(), "models": {}}
+        for scale in [int(scale) for scale in args.scales.split(",")]:
+            result = benchmark_models(scale)
+            results["models"][str(scale)] = result
+            print ("Starts", result["starts"], "Construct", round(result["construct"], 3),
+                   "Music key", round(result["music_key"], 3), "Memory", result["memory"])
+        with open(args.output, "w") as file_out:
+            json.dump(results, file_out, indent=1, sort_keys=True)
+        return
+
+    install_stubs()
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scales": {},
+    }
+    for scale in [int(scale) for scale in args.scales.split(",")]:
+        result = benchmark(scale, args.keep)
+        results["scales"][str(scale)] = result
+        print ("Starts", result["starts"], "Total", round(result["total"], 3))
+        for stage, seconds in sorted(result["stages"].items(), key=lambda item: -item[1]):
+            print ("  " + stage, round(seconds, 3))
+    with open(args.output, "w") as file_out:
+        json.dump(results, file_out, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
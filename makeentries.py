@@ -1,22 +1,30 @@
 #!/usr/bin/python
-from csv import DictReader
 from collections import defaultdict
 
+from music import (ENTRIES_SCHEMA, EventNames, InputSheetError, Schema, clean, input_errors, read_events,
+                   read_sheet)
+
+# names and universities are listed as entered, so only strip them instead of title casing like music.py
+LISTING_SCHEMA = Schema(ENTRIES_SCHEMA.name, [(column, clean) for column, _ in ENTRIES_SCHEMA.columns])
+
 # save spreadsheet to csv
 # read entries into dictionary of event to list of entries
+event_names = EventNames(read_events())
 event_entries = defaultdict(list)
-with open("entries.csv", "r") as file_in:
-    reader = DictReader(file_in)
-    for entry in reader:
-        event = entry["Event"].title().strip()
-        if entry["Gender"] == "Male".title().strip():
-            if "Short" in event:
-                event = event.replace("Short Program", "Mens Short Program")
-            elif "Freeskate" in event:
-                event = event.replace("Freeskate", "Mens Freeskate")
-            elif "Championship" in event:
-                event = event.replace("Championship", "Mens Championship")
-        event_entries[event].append(entry)
+for i, line, entry in read_sheet("entries.csv", LISTING_SCHEMA):
+    event = event_names.find(entry["Event"], entry["Gender"])
+    if event:
+        event_entries[event.name].append(entry)
+    else:
+        # still listed under the name as entered
+        event_entries[entry["Event"].title()].append(entry)
+        input_errors.add(LISTING_SCHEMA.name, line, "Unknown event", entry["Event"], "did you mean",
+                         event_names.suggest(entry["Event"]))
+input_errors.print_report()
+try:
+    input_errors.check_sheets()
+except InputSheetError as e:
+    raise SystemExit(str(e))
 
 # output
 line_separator = "\n"
@@ -26,12 +34,12 @@ with open("output.txt", "w") as file_out:
         entries = set()
         if "Team Maneuver" in event:
             for entry in event_entries[event]:
-                university = entry["University"].strip()
+                university = entry["University"]
                 entries.add(university + "\t" + university)
         else:
             for entry in event_entries[event]:
-                university = entry["University"].strip()
-                skater = entry["First Name"].strip() + " " + entry["Last Name"].strip()
+                university = entry["University"]
+                skater = entry["First Name"] + " " + entry["Last Name"]
                 entries.add(skater + "\t" + university)
         # write data
         file_out.write(event)
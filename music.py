@@ -1,45 +1,164 @@
 #!/usr/bin/python
+import argparse
+import array
+import collections
+import contextlib
+import cPickle
+import cProfile
 import csv
 import datetime
-import eyed3
+import hashlib
+import itertools
+import json
+import operator
 import os
 import re
 import shutil
-import subprocess
-import urllib
+import threading
+import time
+import traceback
+import unicodedata
 import urlparse
-import cgi
 import string
+import Queue
+import StringIO
+
+# eyed3, subprocess and the network modules are imported inside the stages that use them, so commands
+# that only read the model start quickly
 
 directory = os.path.abspath("data")
 
+###################
+# INSTRUMENTATION #
+###################
+
+
+class Instrumentation(object):
+    """Timers and counters for one build.
+
+    Stages record wall and CPU time, spans record per start measurements such as download bytes and ffmpeg
+    seconds, and counters record cache hits, skipped starts and warnings. Everything is thread safe so the
+    download and transcode workers can record as they go.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.began = time.time()
+            self.stages = []
+            self.spans = collections.defaultdict(dict)
+            self.counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall = time.time()
+        cpu = time.clock()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stages.append({"name": name, "wall": time.time() - wall, "cpu": time.clock() - cpu})
+
+    @contextlib.contextmanager
+    def timed_span(self, key, name):
+        began = time.time()
+        try:
+            yield
+        finally:
+            self.span(key, name, time.time() - began)
+
+    def span(self, key, name, value):
+        with self.lock:
+            self.spans[key][name] = self.spans[key].get(name, 0) + value
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def report(self):
+        with self.lock:
+            return {
+                "started": datetime.datetime.fromtimestamp(self.began).isoformat(),
+                "wall": time.time() - self.began,
+                "stages": list(self.stages),
+                "spans": dict(self.spans),
+                "counters": dict(self.counters),
+            }
+
+    def save(self, path):
+        write_json(path, self.report())
+
+    def print_summary(self):
+        report = self.report()
+        print ("Run time", round(report["wall"], 3))
+        for stage in report["stages"]:
+            print ("Stage", stage["name"], "wall", round(stage["wall"], 3), "cpu", round(stage["cpu"], 3))
+        for name, value in sorted(report["counters"].items()):
+            print ("Counter", name, value)
+        for span_name in ["download_seconds", "ffmpeg_seconds", "eyed3_seconds"]:
+            slowest = sorted(report["spans"].items(), key=lambda item: -item[1].get(span_name, 0))[:5]
+            for key, spans in slowest:
+                if span_name in spans:
+                    print ("Slowest", span_name, key, round(spans[span_name], 3))
+
+
+stats = Instrumentation()
+
+
+def warning(*message):
+    stats.count("warnings")
+    print message
+
+
 ##############
 # DATA MODEL #
 ##############
 
 
+def intern_string(value):
+    # share one copy of values repeated across thousands of rows, like levels and universities
+    return intern(value) if isinstance(value, str) else value
+
+
 class Event(object):
+    __slots__ = ["level", "gender", "category", "min_music_length", "max_music_length", "dance", "starts",
+                 "has_submitted_music", "_name", "_short_name"]
 
     def __init__(self, level, gender, category, min_music_length, max_music_length, dance):
-        self.level = level
-        self.gender = gender
-        self.category = category
+        self.level = intern_string(level)
+        self.gender = intern_string(gender)
+        self.category = intern_string(category)
         self.min_music_length = min_music_length
         self.max_music_length = max_music_length
         # back-references
         self.starts = []
         # computed properties
-        self.name = level
-        if gender == "Female":
-            self.name += " Ladies "
-        elif gender == "Male":
-            self.name += " Mens "
-        else:
-            self.name += " "
-        self.name += category
-        self.short_name = self.level + " " + self.category.replace("Solo ", "")
+        self._name = None
+        self._short_name = None
         self.has_submitted_music = (self.max_music_length > 0)
-        self.dance = dance
+        self.dance = intern_string(dance)
+
+    @property
+    def name(self):
+        if self._name is None:
+            name = self.level
+            if self.gender == "Female":
+                name += " Ladies "
+            elif self.gender == "Male":
+                name += " Mens "
+            else:
+                name += " "
+            self._name = intern_string(name + self.category)
+        return self._name
+
+    @property
+    def short_name(self):
+        if self._short_name is None:
+            self._short_name = intern_string(self.level + " " + self.category.replace("Solo ", ""))
+        return self._short_name
 
     def __repr__(self):
         return str(self)
@@ -49,6 +168,7 @@ class Event(object):
 
 
 class Skater(object):
+    __slots__ = ["usfs_number", "first_name", "last_name", "email", "_university", "notes", "starts", "_full_name"]
 
     def __init__(self, usfs_number, first_name, last_name, email):
         self.usfs_number = usfs_number
@@ -60,7 +180,21 @@ class Skater(object):
         # back-references
         self.starts = []
         # computed properties
-        self.full_name = "{} {}".format(self.first_name, self.last_name)
+        self._full_name = None
+
+    @property
+    def university(self):
+        return self._university
+
+    @university.setter
+    def university(self, university):
+        self._university = intern_string(university)
+
+    @property
+    def full_name(self):
+        if self._full_name is None:
+            self._full_name = "{} {}".format(self.first_name, self.last_name)
+        return self._full_name
 
     def __repr__(self):
         return str(self)
@@ -69,13 +203,68 @@ class Skater(object):
         return "Skater: {} {} {}".format(self.full_name, self.usfs_number, self.email)
 
 
+name_keys = {}
+
+
+def name_key(name):
+    # case, whitespace, punctuation and diacritic insensitive form of a name, memoized since names repeat a lot
+    key = name_keys.get(name)
+    if key is None:
+        text = name.decode("utf-8", "ignore") if isinstance(name, str) else name
+        text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+        text = re.sub(r"[\W_]+", " ", text.encode("ascii", "ignore").lower())
+        key = " ".join(text.split())
+        name_keys[name] = key
+    return key
+
+
+def trigrams(key):
+    padded = "  " + key + " "
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def usfs_differs(skater, usfs_number):
+    return bool(usfs_number and skater.usfs_number and skater.usfs_number != usfs_number)
+
+
 class Skaters(object):
+    """Index of skaters by USFS number, name and email.
+
+    Names are indexed by name_key, so lookups ignore case, whitespace and diacritics. Every key maps to a list
+    of skaters, so two skaters sharing an email or name are reported instead of one replacing the other.
+    Skaters with different USFS numbers are never merged by name or email, and when several skaters share a
+    key the one matching the most other fields is used.
+    Names are also indexed by trigram, which ranks near misses when no exact key matches. Submission rows are
+    resolved with resolve, which remembers each distinct row.
+    """
+
+    # minimum trigram similarity for a near miss, and how far ahead of the runner up it has to be
+    fuzzy_threshold = 0.6
+    fuzzy_margin = 0.1
 
     def __init__(self):
         self.skaters = []
-        self.skaters_by_usfs = {}
-        self.skaters_by_name = {}
-        self.skaters_by_email = {}
+        self.skaters_by_usfs = collections.defaultdict(list)
+        self.skaters_by_name = collections.defaultdict(list)
+        self.skaters_by_email = collections.defaultdict(list)
+        self.skaters_by_trigram = collections.defaultdict(list)
+        self.trigrams = {}
+        self.resolved = {}
+
+    def add(self, skater):
+        self.skaters.append(skater)
+        name = name_key(skater.full_name)
+        email = skater.email.lower()
+        for postings, key, kind in [(self.skaters_by_usfs, skater.usfs_number, "USFS number"),
+                                    (self.skaters_by_name, name, "name"),
+                                    (self.skaters_by_email, email, "email")]:
+            if key:
+                if postings[key]:
+                    warning("Warning skaters share " + kind, key, postings[key], skater)
+                postings[key].append(skater)
+        self.trigrams[skater] = trigrams(name)
+        for trigram in self.trigrams[skater]:
+            self.skaters_by_trigram[trigram].append(skater)
 
     def find_or_create(self, usfs_number, first_name, last_name, email):
         if usfs_number == "0" or usfs_number == "none":
@@ -84,47 +273,111 @@ class Skaters(object):
         skater = self.find(usfs_number, full_name, email)
         if not skater:
             skater = Skater(usfs_number, first_name, last_name, email)
-            self.skaters.append(skater)
-            self.skaters_by_usfs[usfs_number] = skater
-            self.skaters_by_name[full_name] = skater
-            self.skaters_by_email[email] = skater
+            self.add(skater)
         return skater
 
-    def find(self, usfs_number, name, email):
-        if usfs_number and usfs_number in self.skaters_by_usfs and self.skaters_by_usfs[usfs_number].last_name in name:
-            skater = self.skaters_by_usfs[usfs_number]
-        elif name and name in self.skaters_by_name:
-            skater = self.skaters_by_name[name]
-            print ("Warning matching skater by name", name, email, usfs_number, skater)
-        elif email and email in self.skaters_by_email:
-            skater = self.skaters_by_email[email]
-            print ("Warning matching skater by email", name, email, usfs_number, skater)
+    def find(self, usfs_number, name, email, fuzzy=False):
+        name = name_key(name) if name else ""
+        email = email.lower() if email else ""
+        by_usfs = [skater for skater in self.skaters_by_usfs.get(usfs_number, []) if usfs_number and
+                   name_key(skater.last_name) in name]
+        by_name = self.same_usfs(self.skaters_by_name.get(name, []) if name else [], usfs_number, "name")
+        by_email = []
+        if not by_usfs and not by_name:
+            by_email = self.same_usfs(self.skaters_by_email.get(email, []) if email else [], usfs_number, "email")
+        if by_usfs:
+            skater = self.best(by_usfs, usfs_number, name, email)
+        elif by_name:
+            skater = self.best(by_name, usfs_number, name, email)
+            warning("Warning matching skater by name", name, email, usfs_number, skater)
+        elif by_email:
+            skater = self.best(by_email, usfs_number, name, email)
+            warning("Warning matching skater by email", name, email, usfs_number, skater)
+        elif fuzzy and name:
+            skater = None
+            candidates = [(score, candidate) for score, candidate in self.candidates(name)
+                          if not usfs_differs(candidate, usfs_number)]
+            if candidates and candidates[0][0] >= self.fuzzy_threshold:
+                if len(candidates) == 1 or candidates[0][0] - candidates[1][0] >= self.fuzzy_margin:
+                    skater = candidates[0][1]
+                    warning("Warning matching skater by similar name", name, email, usfs_number, skater)
+                else:
+                    warning("Warning ambiguous skater", name, email, usfs_number, candidates[:5])
         else:
             skater = None
         return skater
 
+    def same_usfs(self, skaters, usfs_number, kind):
+        # a skater with a different USFS number is someone else who happens to share a name or an email
+        matches = [skater for skater in skaters if not usfs_differs(skater, usfs_number)]
+        if skaters and not matches:
+            warning("Warning skater shares " + kind + " but not USFS number", usfs_number, skaters)
+        return matches
+
+    def best(self, skaters, usfs_number, name, email):
+        # rank skaters sharing a key by how many of the other fields also match
+        if len(skaters) == 1:
+            return skaters[0]
+        ranked = sorted(skaters, key=lambda skater: (bool(usfs_number) and skater.usfs_number == usfs_number,
+                                                     name_key(skater.full_name) == name,
+                                                     skater.email.lower() == email), reverse=True)
+        warning("Warning ambiguous skater", name, email, usfs_number, ranked)
+        return ranked[0]
+
+    def candidates(self, name, limit=10):
+        # rank skaters by trigram similarity, looking only at skaters sharing one of the rarer trigrams
+        query = trigrams(name_key(name))
+        known = [trigram for trigram in query if trigram in self.skaters_by_trigram]
+        candidates = set()
+        for trigram in sorted(known, key=lambda trigram: len(self.skaters_by_trigram[trigram]))[:3]:
+            candidates.update(self.skaters_by_trigram[trigram])
+        ranked = []
+        for skater in candidates:
+            shared = len(query & self.trigrams[skater])
+            ranked.append((float(shared) / (len(query) + len(self.trigrams[skater]) - shared), skater))
+        ranked.sort(key=lambda candidate: -candidate[0])
+        return ranked[:limit]
+
+    def resolve(self, usfs_number, name, email):
+        # look up a submission row, each distinct row is only resolved once even if it is repeated
+        query = (usfs_number, name, email)
+        if query not in self.resolved:
+            self.resolved[query] = self.find(usfs_number, name, email, fuzzy=True)
+        return self.resolved[query]
+
     def find_by_name_and_university(self, name, university):
-        if name in self.skaters_by_name:
-            skater = self.skaters_by_name[name]
-            if skater.university == university:
-                return skater
-            else:
-                print (skater.university, university)
+        matches = self.skaters_by_name.get(name_key(name), [])
+        by_university = [skater for skater in matches if name_key(skater.university) == name_key(university)]
+        if len(by_university) > 1:
+            warning("Warning skaters share name and university", name, university, by_university)
+        if by_university:
+            return by_university[0]
+        for skater in matches:
+            print (skater.university, university)
         return None
 
 
 class Start(object):
+    __slots__ = ["skater", "event", "music_submissions", "_music_key", "music_length", "length_status",
+                 "confirmed"]
 
     def __init__(self, skater, event):
         self.skater = skater
         self.event = event
         self.music_submissions = []
-        self.music_key = re.sub(r"\W+", "_", event.name + "  " + skater.full_name)
+        self._music_key = None
         self.music_length = 0
+        self.length_status = ""
         self.confirmed = False
         skater.starts.append(self)
         event.starts.append(self)
 
+    @property
+    def music_key(self):
+        if self._music_key is None:
+            self._music_key = re.sub(r"\W+", "_", self.event.name + "  " + self.skater.full_name)
+        return self._music_key
+
     def last_music_submission(self):
         if self.music_submissions:
             return self.music_submissions[-1]
@@ -139,6 +392,7 @@ class Start(object):
 
 
 class MusicSubmission(object):
+    __slots__ = ["skater", "event", "url", "index"]
 
     def __init__(self, skater, event, url, index):
         self.skater = skater
@@ -164,20 +418,151 @@ def int_or_zero(s):
     return int(s)
 
 
+def clean(value):
+    return value.strip()
+
+
+def clean_title(value):
+    return value.strip().title()
+
+
+def clean_name(value):
+    return " ".join(value.split()).title()  # clean up whitespace
+
+
+def unchanged(value):
+    return value
+
+
+class Schema(object):
+    """Columns one input sheet must have, each with the function that cleans its values."""
+
+    def __init__(self, name, columns):
+        self.name = name
+        self.columns = columns
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        return "Schema: {}".format(self.name)
+
+
+EVENTS_SCHEMA = Schema("events.csv", [
+    ("Level", clean),
+    ("Gender", clean),
+    ("Category", clean),
+    ("Min Music Length", int_or_zero),
+    ("Max Music Length", int_or_zero),
+    ("Dance", clean),
+])
+ENTRIES_SCHEMA = Schema("entries.csv", [
+    ("Event", clean_title),
+    ("Gender", clean),
+    ("USF #", clean),
+    ("First Name", clean_title),
+    ("Last Name", clean_title),
+    ("E-mail", clean),
+    ("University", clean_title),
+])
+UPDATED_ENTRIES_SCHEMA = Schema("updated_entries.csv", [
+    ("Name", clean_name),
+    ("University", clean_title),
+])
+SUBMISSIONS_SCHEMA = Schema("input.csv", [
+    ("USFS Number", clean),
+    ("Skater Name", clean_title),
+    ("Email Address", clean),
+    ("Notes for Announcer", unchanged),
+    ("Free Dance Event", clean),
+    ("Free Dance Music", clean),
+    ("Free Skate Event", clean),
+    ("Free Skate Music", clean),
+    ("Short Program Event", clean),
+    ("Short Program Music", clean),
+])
+
+
+class InputSheetError(Exception):
+    pass
+
+
+class InputErrors(object):
+    """Problems with individual rows of the input sheets, gathered while reading and reported together.
+
+    Problems with a whole sheet, such as missing columns, are recorded with add_sheet and stop the build in
+    check_sheets, before any stage rewrites reports or prunes music from a model missing that sheet.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.errors = []
+        self.sheets = []
+
+    def reset(self):
+        with self.lock:
+            self.errors = []
+            self.sheets = []
+
+    def add(self, sheet, line, *message):
+        stats.count("input_errors")
+        with self.lock:
+            self.errors.append((sheet, line, " ".join(str(part) for part in message)))
+
+    def add_sheet(self, sheet, *message):
+        self.add(sheet, 1, *message)
+        with self.lock:
+            if sheet not in self.sheets:
+                self.sheets.append(sheet)
+
+    def check_sheets(self):
+        with self.lock:
+            sheets = list(self.sheets)
+        if sheets:
+            raise InputSheetError("Cannot build from " + ", ".join(sheets))
+
+    def print_report(self):
+        with self.lock:
+            if self.errors:
+                print ("Input errors", len(self.errors))
+            for sheet, line, message in self.errors:
+                print "{}:{}: {}".format(sheet, line, message)
+
+
+input_errors = InputErrors()
+
+
+def read_sheet(path, schema):
+    # stream cleaned rows as (row index, line number, row), rows that fail to clean are reported and skipped
+    with open(path, "r") as file_in:
+        reader = csv.DictReader(file_in)
+        missing = [column for column, _ in schema.columns if column not in (reader.fieldnames or [])]
+        if missing:
+            input_errors.add_sheet(schema.name, "Missing columns", ", ".join(missing))
+            return
+        for i, row in enumerate(reader):
+            cleaned = {}
+            try:
+                for column, clean_value in schema.columns:
+                    cleaned[column] = clean_value(row[column] or "")
+            except ValueError:
+                input_errors.add(schema.name, reader.line_num, "Bad value for", column, repr(row[column]))
+                continue
+            yield i, reader.line_num, cleaned
+
+
 def read_events():
     events = []
-    with open("events.csv", "r") as file_in:
-        reader = csv.DictReader(file_in)
-        for row in reader:
-            event = Event(
-                level=row["Level"],
-                gender=row["Gender"],
-                category=row["Category"],
-                min_music_length=int_or_zero(row["Min Music Length"]),
-                max_music_length=int_or_zero(row["Max Music Length"]),
-                dance=row["Dance"]
-            )
-            events.append(event)
+    for i, line, row in read_sheet("events.csv", EVENTS_SCHEMA):
+        event = Event(
+            level=row["Level"],
+            gender=row["Gender"],
+            category=row["Category"],
+            min_music_length=row["Min Music Length"],
+            max_music_length=row["Max Music Length"],
+            dance=row["Dance"]
+        )
+        events.append(event)
     return events
 
 
@@ -190,161 +575,861 @@ def create_submission(skater, event_name, url, index):
                     start.music_submissions.append(submission)
                     break
             else:
-                print ("Warning cannot find start", event_name, skater.starts)
+                warning("Warning cannot find start", event_name, skater.starts)
         else:
-            print ("Missing event name", skater)
+            warning("Missing event name", skater)
+
+
+def read_submissions(skaters, indexes=None):
+    # with indexes, only those rows are applied
+    for i, line, row in read_sheet(os.path.join(directory, "input.csv"), SUBMISSIONS_SCHEMA):
+        if indexes is not None and i not in indexes:
+            continue
+        usfs_number = row["USFS Number"]
+        name = row["Skater Name"]
+        email = row["Email Address"]
+        skater = skaters.resolve(usfs_number, name, email)
+        if skater:
+            notes = row["Notes for Announcer"]
+            if notes:
+                skater.notes = notes
+
+            free_dance_event = row["Free Dance Event"]
+            free_dance_url = row["Free Dance Music"]
+            free_skate_event = row["Free Skate Event"]
+            free_skate_url = row["Free Skate Music"]
+            short_event = row["Short Program Event"]
+            short_url = row["Short Program Music"]
+
+            create_submission(skater, free_dance_event, free_dance_url, i)
+            create_submission(skater, free_skate_event, free_skate_url, i)
+            create_submission(skater, short_event, short_url, i)
+        else:
+            input_errors.add(SUBMISSIONS_SCHEMA.name, line, "Cannot find skater", name, email, usfs_number)
+
+
+def update_submissions(skaters, events, indexes):
+    """Apply the new or changed rows of input.csv to a model read from an earlier copy of it."""
+    starts = [start for event in events for start in event.starts]
+    for start in starts:
+        start.music_submissions = [submission for submission in start.music_submissions
+                                   if submission.index not in indexes]
+    read_submissions(skaters, indexes)
+    # changed rows were appended after later ones, the last submission has to be the last row again
+    for start in starts:
+        if len(start.music_submissions) > 1:
+            start.music_submissions.sort(key=operator.attrgetter("index"))
+
+
+class MusicIndex(object):
+    """Index of a music directory from file name stem to file name.
+
+    The directory is listed once, on the first lookup, and downloads are added as they land. Every build,
+    including each rebuild in watch mode, makes a new MusicLibrary and so lists the directory again.
+    """
+
+    def __init__(self, subdir):
+        self.subdir = subdir
+        self.lock = threading.Lock()
+        self.files = None
+
+    def scan(self):
+        files = {}
+        for file_name in os.listdir(os.path.join(directory, self.subdir)):
+            if not file_name.endswith(PARTIAL_SUFFIX):
+                files[os.path.splitext(file_name)[0]] = file_name
+        return files
+
+    def get(self, stem):
+        with self.lock:
+            if self.files is None:
+                self.files = self.scan()
+            return self.files.get(stem)
+
+    def add(self, file_name):
+        with self.lock:
+            if self.files is not None:
+                self.files[os.path.splitext(file_name)[0]] = file_name
+
+
+def get_cached_music(start, index):
+    prefix = str(start.last_music_submission().index) + "_" + start.music_key
+    return index.get(prefix)
+
+
+def music_download_url(submission):
+    url = submission.url
+    parsed_url = urlparse.urlparse(url)
+    if parsed_url.netloc == "drive.google.com":
+        # open?id=<id> links and the /file/d/<id>/view links Drive shares by default
+        file_id = urlparse.parse_qs(parsed_url.query).get("id", [None])[0]
+        match = re.match(r"/file/d/([^/]+)", parsed_url.path)
+        if match:
+            file_id = match.group(1)
+        if not file_id:
+            raise ValueError("Cannot find the file id in Google Drive link", url)
+        url = "https://drive.google.com/uc?export=download&id=" + file_id
+    return url
+
+
+PARTIAL_SUFFIX = ".part"
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+# (offset, magic bytes, extension) for the containers plan_conversion accepts
+MAGIC_NUMBERS = [
+    (0, "ID3", ".mp3"),
+    (0, "\xff\xfb", ".mp3"),
+    (0, "\xff\xf3", ".mp3"),
+    (0, "\xff\xf2", ".mp3"),
+    (8, "WAVE", ".wav"),
+    (4, "ftyp", ".m4a"),
+    (8, "AIFF", ".aiff"),
+    (8, "AIFC", ".aiff"),
+    (0, "\x30\x26\xb2\x75\x8e\x66\xcf\x11", ".wma"),
+]
+
+
+def disposition_filename(header):
+    """File name from a Content-Disposition header, preferring the RFC 5987 filename* form."""
+    import urllib
+    if not header:
+        return None
+    match = re.search(r"filename\*\s*=\s*[^']*'[^']*'([^;]+)", header)
+    if match:
+        return urllib.unquote(match.group(1).strip().strip("\""))
+    match = re.search(r'filename\s*=\s*(?:"([^"]*)"|([^;]+))', header)
+    if match:
+        return (match.group(1) if match.group(1) is not None else match.group(2)).strip()
+    return None
 
 
-def read_submissions(skaters):
-    with open(os.path.join(directory, "input.csv"), "r") as file_in:
-        reader = csv.DictReader(file_in)
-        for i, row in enumerate(reader):
-            usfs_number = row["USFS Number"]
-            name = row["Skater Name"].strip().title()
-            email = row["Email Address"].strip()
-            skater = skaters.find(usfs_number, name, email)
-            if skater:
-                notes = row["Notes for Announcer"]
-                if notes:
-                    skater.notes = notes
-
-                free_dance_event = row["Free Dance Event"]
-                free_dance_url = row["Free Dance Music"]
-                free_skate_event = row["Free Skate Event"]
-                free_skate_url = row["Free Skate Music"]
-                short_event = row["Short Program Event"]
-                short_url = row["Short Program Music"]
-
-                create_submission(skater, free_dance_event, free_dance_url, i)
-                create_submission(skater, free_skate_event, free_skate_url, i)
-                create_submission(skater, short_event, short_url, i)
-            else:
-                print ("Warning cannot find skater", name, email, usfs_number)
+def sniff_extension(path):
+    with open(path, "rb") as file_in:
+        head = file_in.read(16)
+    for offset, magic, extension in MAGIC_NUMBERS:
+        if head[offset:offset + len(magic)] == magic:
+            return extension
+    return ""
 
 
-def get_cached_music(start, subdir):
-    prefix = str(start.last_music_submission().index) + "_" + start.music_key
-    for file_name in os.listdir(os.path.join(directory, subdir)):
-        if os.path.splitext(file_name)[0] == prefix:
-            return file_name
-    return None
+class HttpConnections(object):
+    """Keep-alive HTTP connections, one per host for each thread, reused across downloads.
 
+    fetch() streams a URL into a file and resumes from whatever the file already holds with a Range
+    request, so a download interrupted part way only transfers the rest on the next attempt.
+    """
 
-def download_music(start):
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connections(self):
+        if not hasattr(self.local, "connections"):
+            self.local.connections = {}
+        return self.local.connections
+
+    def connection(self, scheme, host):
+        import httplib
+        connections = self.connections()
+        if (scheme, host) not in connections:
+            if scheme == "https":
+                connections[(scheme, host)] = httplib.HTTPSConnection(host, timeout=self.timeout)
+            elif scheme == "http":
+                connections[(scheme, host)] = httplib.HTTPConnection(host, timeout=self.timeout)
+            else:
+                raise IOError("Unsupported URL scheme", scheme)
+        return connections[(scheme, host)]
+
+    def close(self, url):
+        parsed_url = urlparse.urlparse(url)
+        connection = self.connections().pop((parsed_url.scheme, parsed_url.netloc), None)
+        if connection:
+            connection.close()
+
+    def request(self, url, headers):
+        import httplib
+        import socket
+        parsed_url = urlparse.urlparse(url)
+        path = parsed_url.path or "/"
+        if parsed_url.query:
+            path += "?" + parsed_url.query
+        # the server may have closed a kept-alive connection since its last use, so retry once on a new one
+        for attempt in range(2):
+            connection = self.connection(parsed_url.scheme, parsed_url.netloc)
+            try:
+                connection.request("GET", path, headers=headers)
+                return connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                self.close(url)
+                if attempt:
+                    raise
+
+    def get(self, url, headers, redirects=5):
+        """The final URL and response of a GET, following redirects. The caller reads the response fully."""
+        for _ in range(redirects + 1):
+            response = self.request(url, headers)
+            location = response.getheader("Location")
+            if response.status not in REDIRECT_STATUSES or not location:
+                return url, response
+            response.read()
+            url = urlparse.urljoin(url, location)
+        raise IOError("Too many redirects", url)
+
+    def fetch(self, url, path, chunk_size=64 * 1024):
+        """Download url into path, appending to a partial download already there. Returns the response.
+
+        Raises IOError when the server sends fewer bytes than it announced. The partial file is kept so the
+        next attempt resumes from it.
+        """
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+        url, response = self.get(url, headers)
+        if response.status == 206:
+            content_range = re.match(r"bytes (\d+)-\d+/(\d+|\*)", response.getheader("Content-Range", ""))
+            if not content_range or int(content_range.group(1)) != offset:
+                # the server resumed from somewhere else, start again
+                response.read()
+                os.remove(path)
+                return self.fetch(url, path, chunk_size)
+            mode = "ab"
+        elif response.status == 416:
+            # the partial file is not a prefix of what the server has any more
+            response.read()
+            os.remove(path)
+            return self.fetch(url, path, chunk_size)
+        elif response.status == 200:
+            mode = "wb"
+            offset = 0
+        else:
+            response.read()
+            raise IOError("HTTP error", response.status, response.reason, url)
+
+        content_length = response.getheader("Content-Length")
+        expected_size = offset + int(content_length) if content_length is not None else None
+        if response.status == 206 and content_range.group(2) != "*":
+            expected_size = int(content_range.group(2))
+        size = offset
+        try:
+            with open(path, mode) as file_out:
+                while True:
+                    chunk = response.read(chunk_size)
+                    if not chunk:
+                        break
+                    file_out.write(chunk)
+                    size += len(chunk)
+        except Exception:
+            self.close(url)
+            raise
+        if expected_size is not None and size != expected_size:
+            self.close(url)
+            if size > expected_size:
+                os.remove(path)
+            raise IOError("Download size mismatch", url, size, expected_size)
+        if not size:
+            raise IOError("Empty download", url)
+        return response
+
+
+def download_music(start, index, connections):
     # TODO use google drive API
-    if start.music_submissions and not get_cached_music(start, "music_raw"):
+    if start.music_submissions and not get_cached_music(start, index):
         submission = start.last_music_submission()
-        url = submission.url
-        parsed_url = urlparse.urlparse(url)
-        if parsed_url.netloc == "drive.google.com":
-            query_params = urlparse.parse_qs(parsed_url.query)
-            url = "https://drive.google.com/uc?export=download&id=" + query_params["id"][0]
+        url = music_download_url(submission)
+        music_stem = str(submission.index) + "_" + start.music_key
+        part_path = os.path.join(directory, "music_raw", music_stem + PARTIAL_SUFFIX)
+        if os.path.exists(part_path):
+            stats.count("download_resumes")
 
         print "Downloading music from " + url
-        (download_path, headers) = urllib.urlretrieve(url)
-
-        original_filename = None
-        for disposition in headers["Content-Disposition"].split(";"):
-            disposition_parts = disposition.split("=")
-            if len(disposition_parts) == 2 and disposition_parts[0] == "filename":
-                original_filename = disposition_parts[1].strip("\"")
+        with stats.timed_span(start.music_key, "download_seconds"):
+            response = connections.fetch(url, part_path)
 
-        file_extension = os.path.splitext(original_filename)[1]
-        music_filename = str(submission.index) + "_" + start.music_key + file_extension
+        original_filename = disposition_filename(response.getheader("Content-Disposition"))
+        file_extension = os.path.splitext(original_filename or "")[1] or sniff_extension(part_path)
+        music_filename = music_stem + file_extension
         music_path = os.path.join(directory, "music_raw", music_filename)
-        shutil.copy(download_path, music_path)
+        os.rename(part_path, music_path)
+        index.add(music_filename)
+        stats.span(start.music_key, "download_bytes", os.path.getsize(music_path))
+        stats.count("downloads")
+
 
+class DownloadPool(object):
+    """Downloads music for many starts at once with a bounded number of worker threads.
 
-def convert_music(start):
+    At most per_host downloads run against the same host at a time. Failed downloads are retried
+    with exponential backoff and then reported in a summary instead of stopping the run.
+    """
+
+    def __init__(self, index, workers=8, per_host=4, retries=3, backoff=1.0):
+        self.index = index
+        self.workers = workers
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.host_limits = {}
+        self.connections = HttpConnections()
+        self.failures = []
+
+    def host_limit(self, url):
+        host = urlparse.urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = threading.BoundedSemaphore(self.per_host)
+            return self.host_limits[host]
+
+    def download(self, start):
+        url = start.last_music_submission().url
+        try:
+            url = music_download_url(start.last_music_submission())
+        except Exception as e:
+            # a link we cannot resolve will not resolve on a retry either
+            with self.lock:
+                self.failures.append((start, url, e))
+            return
+        limit = self.host_limit(url)
+        for attempt in range(self.retries + 1):
+            try:
+                with limit:
+                    download_music(start, self.index, self.connections)
+                return
+            except Exception as e:
+                if attempt < self.retries:
+                    delay = self.backoff * 2 ** attempt
+                    print ("Retrying download", start.music_key, repr(e), delay)
+                    time.sleep(delay)
+                else:
+                    with self.lock:
+                        self.failures.append((start, url, e))
+
+    def worker(self, queue):
+        while True:
+            try:
+                start = queue.get_nowait()
+            except Queue.Empty:
+                return
+            self.download(start)
+
+    def run(self, starts):
+        queue = Queue.Queue()
+        for start in starts:
+            if start.music_submissions and not get_cached_music(start, self.index):
+                queue.put(start)
+        threads = []
+        for _ in range(min(self.workers, queue.qsize())):
+            thread = threading.Thread(target=self.worker, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        self.print_failures()
+        return self.failures
+
+    def print_failures(self):
+        if self.failures:
+            print ("Download failures", len(self.failures))
+            for start, url, error in self.failures:
+                print ("Failed download", start.music_key, url, repr(error))
+
+
+TRANSCODE_ARGS = ["-acodec", "mp3", "-ab", "256k"]
+
+
+class Transcode(object):
+
+    def __init__(self, start, input_path, output_path, title, album, source_hash, args=TRANSCODE_ARGS):
+        self.start = start
+        self.input_path = input_path
+        self.output_path = output_path
+        self.title = title
+        self.album = album
+        self.source_hash = source_hash
+        self.args = args
+        self.cache_key = hashlib.sha1(json.dumps([source_hash, self.args, title, album])).hexdigest()
+        # filled in by transcode_music, or by TranscodePool when converting or tagging raises
+        self.returncode = None
+        self.stderr = ""
+        self.error = None
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        return "Transcode: {} {}".format(self.start.music_key, self.returncode)
+
+
+def hash_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as file_in:
+        for chunk in iter(lambda: file_in.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def write_file(path, data):
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file_out:
+        file_out.write(data)
+    os.rename(temp_path, path)
+
+
+def write_json(path, data):
+    write_file(path, json.dumps(data, indent=1, sort_keys=True))
+
+
+class TranscodeCache(object):
+    """Manifest of converted music, persisted in data/transcode_cache.json between runs.
+
+    Each output mp3 is recorded with a key hashed from the raw file contents, the ffmpeg arguments and the
+    tags, so a conversion is skipped only if none of them changed. Raw file hashes are remembered by
+    mtime and size so unchanged raw files are not read again.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(directory, "transcode_cache.json")
+        self.lock = threading.Lock()
+        self.outputs = {}
+        self.sources = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as file_in:
+                data = json.load(file_in)
+            self.outputs = data["outputs"]
+            self.sources = data["sources"]
+
+    def source_hash(self, path):
+        stat = os.stat(path)
+        name = os.path.basename(path)
+        with self.lock:
+            source = self.sources.get(name)
+        if source and source["mtime"] == stat.st_mtime and source["size"] == stat.st_size:
+            return source["hash"]
+        source = {"mtime": stat.st_mtime, "size": stat.st_size, "hash": hash_file(path)}
+        with self.lock:
+            self.sources[name] = source
+        return source["hash"]
+
+    def is_current(self, transcode):
+        output = self.outputs.get(os.path.basename(transcode.output_path))
+        return bool(output) and output["key"] == transcode.cache_key and os.path.exists(transcode.output_path)
+
+    def record(self, transcode):
+        with self.lock:
+            self.outputs[os.path.basename(transcode.output_path)] = {
+                "key": transcode.cache_key,
+                "source": os.path.basename(transcode.input_path),
+                "source_hash": transcode.source_hash,
+            }
+
+    def prune(self, starts):
+        output_names = set(start.music_key + ".mp3" for start in starts)
+        for output_name in list(self.outputs):
+            if output_name not in output_names:
+                output_path = os.path.join(directory, "music", output_name)
+                print ("Removing stale music", output_path)
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+                del self.outputs[output_name]
+        for source_name in list(self.sources):
+            if not os.path.exists(os.path.join(directory, "music_raw", source_name)):
+                del self.sources[source_name]
+
+    def save(self):
+        with self.lock:
+            write_json(self.path, {"outputs": self.outputs, "sources": self.sources})
+
+
+def plan_conversion(start, library):
     if start.music_submissions:
-        input_file_name = get_cached_music(start, "music_raw")
+        input_file_name = get_cached_music(start, library.raw_index)
         if input_file_name:
             input_path = os.path.join(directory, "music_raw", input_file_name)
             output_path = os.path.join(directory, "music", start.music_key + ".mp3")
+            file_extension = os.path.splitext(input_file_name)[1]
+            if file_extension.lower() not in [".mp3", ".wav", ".m4a", ".aif", ".aiff", ".wma", ".mp2", ".m4v", ""]:
+                warning("Unknown music format", input_file_name)
+                return None
             version = len(start.music_submissions)
-            if version > read_version(output_path):
-                if version > 1:
+            title = start.skater.full_name + " " + str(version)
+            album = start.event.name
+            source_hash = library.transcodes.source_hash(input_path)
+            if library.store:
+                library.store.add_raw(input_path, source_hash)
+            transcode = Transcode(start, input_path, output_path, title, album, source_hash,
+                                  library.transcode_args(source_hash))
+            if library.transcodes.is_current(transcode):
+                stats.count("transcode_cache_hits")
+            else:
+                if version > 1 and version > read_version(output_path, library.metadata):
                     print ("Overriding submission", output_path, version)
-                title = start.skater.full_name + " " + str(version)
-                album = start.event.name
-                file_extension = os.path.splitext(input_file_name)[1]
-                if file_extension.lower() in [".mp3", ".wav", ".m4a", ".aif", ".aiff", ".wma", ".mp2", ".m4v", ""]:
-                    print ("Converting", input_file_name)
-                    subprocess.call(["ffmpeg", "-y", "-i", input_path, "-acodec", "mp3", "-ab", "256k", output_path])
-                else:
-                    print ("Unknown music format", input_file_name)
-                    return
-
-                mp3_file = eyed3.load(output_path)
-                if mp3_file.tag:
-                    mp3_file.tag.clear()
-                else:
-                    mp3_file.initTag()
-                mp3_file.tag.title = unicode(title)
-                mp3_file.tag.album = unicode(album)
-                mp3_file.tag.save(output_path)
+                return transcode
+    return None
 
 
-def read_version(path):
-    if os.path.exists(path):
+def transcode_music(transcode):
+    import subprocess
+    print ("Converting", os.path.basename(transcode.input_path))
+    with open(os.devnull, "r") as devnull, stats.timed_span(transcode.start.music_key, "ffmpeg_seconds"):
+        process = subprocess.Popen(
+            ["ffmpeg", "-y", "-i", transcode.input_path] + transcode.args + [transcode.output_path],
+            stdin=devnull, stdout=devnull, stderr=subprocess.PIPE)
+        transcode.stderr = process.communicate()[1]
+    transcode.returncode = process.returncode
+    stats.count("transcodes")
+    return transcode.returncode == 0
+
+
+def tag_music(transcode):
+    import eyed3
+    with stats.timed_span(transcode.start.music_key, "eyed3_seconds"):
+        mp3_file = eyed3.load(transcode.output_path)
+        if mp3_file.tag:
+            mp3_file.tag.clear()
+        else:
+            mp3_file.initTag()
+        mp3_file.tag.title = unicode(transcode.title)
+        mp3_file.tag.album = unicode(transcode.album)
+        mp3_file.tag.save(transcode.output_path)
+
+
+def run_transcode(transcode, library):
+    if library.store:
+        return library.store.transcode(transcode)
+    return transcode_music(transcode)
+
+
+class TranscodePool(object):
+    """Runs several ffmpeg processes at once, one per CPU unless told otherwise.
+
+    Each start is tagged as soon as its own transcode finishes. Exit codes, stderr and any exception raised
+    while converting or tagging are kept on the Transcode objects so failures can be reported together at
+    the end of the stage.
+    """
+
+    def __init__(self, library, workers=None):
+        import multiprocessing
+        self.library = library
+        self.workers = workers or multiprocessing.cpu_count()
+        self.lock = threading.Lock()
+        self.transcodes = []
+
+    def worker(self, queue):
+        while True:
+            try:
+                transcode = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                if run_transcode(transcode, self.library):
+                    tag_music(transcode)
+                    self.library.transcodes.record(transcode)
+            except Exception as e:
+                transcode.error = e
+
+    def run(self, starts):
+        if self.library.normalize:
+            analyse_loudness(starts, self.library, self.workers)
+        queue = Queue.Queue()
+        for start in starts:
+            transcode = plan_conversion(start, self.library)
+            if transcode:
+                self.transcodes.append(transcode)
+                queue.put(transcode)
+        threads = []
+        for _ in range(min(self.workers, queue.qsize())):
+            thread = threading.Thread(target=self.worker, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        self.library.transcodes.save()
+        self.print_failures()
+        return self.transcodes
+
+    def failures(self):
+        return [transcode for transcode in self.transcodes if transcode.returncode != 0 or transcode.error]
+
+    def print_failures(self):
+        failures = self.failures()
+        if failures:
+            print ("Conversion failures", len(failures))
+            for transcode in failures:
+                print ("Failed conversion", transcode.start.music_key, transcode.returncode, repr(transcode.error))
+                print transcode.stderr.strip()[-2000:]
+
+
+def read_metadata(path):
+    import eyed3
+    with stats.timed_span(os.path.splitext(os.path.basename(path))[0], "eyed3_seconds"):
         mp3_file = eyed3.load(path)
-        return int(mp3_file.tag.title.split()[-1])
+    if mp3_file is None:
+        warning("Cannot read music", path)
+        return {"duration": 0, "version": 0, "title": None, "album": None}
+    title = None
+    album = None
+    if mp3_file.tag:
+        title = mp3_file.tag.title
+        album = mp3_file.tag.album
+    # our own titles end in the submission count, other music such as dance tracks may end in any word
+    words = title.split() if title else []
+    return {
+        "duration": mp3_file.info.time_secs,
+        "version": int(words[-1]) if words and words[-1].isdigit() else 0,
+        "title": title,
+        "album": album,
+    }
+
+
+class MetadataCache(object):
+    """Duration and tags of converted music, persisted in data/metadata_cache.json between runs.
+
+    Entries are keyed by path relative to the data directory and reused while the file's mtime and size
+    are unchanged, so eyed3 only parses files that were converted since the last run.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(directory, "metadata_cache.json")
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as file_in:
+                self.entries = json.load(file_in)
+
+    def get(self, path, decode=False):
+        stat = os.stat(path)
+        name = os.path.relpath(path, directory)
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+            stats.count("metadata_cache_hits")
+        else:
+            stats.count("metadata_cache_misses")
+            entry = read_metadata(path)
+            entry["mtime"] = stat.st_mtime
+            entry["size"] = stat.st_size
+            with self.lock:
+                self.entries[name] = entry
+        if decode and "decoded_duration" not in entry:
+            entry["decoded_duration"] = decode_duration(path)
+        return entry
+
+    def save(self):
+        with self.lock:
+            for name in list(self.entries):
+                if not os.path.exists(os.path.join(directory, name)):
+                    del self.entries[name]
+            write_json(self.path, self.entries)
+
+
+def read_version(path, metadata):
+    if os.path.exists(path):
+        return metadata.get(path)["version"]
     else:
         return 0
 
 
-def read_time(start):
+def decode_duration(path):
+    # the header duration is an estimate for VBR files, decoding the whole file gives the real length
+    import subprocess
+    with open(os.devnull, "r") as devnull, stats.timed_span(os.path.splitext(os.path.basename(path))[0],
+                                                            "decode_seconds"):
+        process = subprocess.Popen(["ffmpeg", "-i", path, "-f", "null", "-"],
+                                   stdin=devnull, stdout=devnull, stderr=subprocess.PIPE)
+        stderr = process.communicate()[1]
+    times = re.findall(r"time=(\d+):(\d+):(\d+(?:\.\d+)?)", stderr)
+    if process.returncode != 0 or not times:
+        warning("Cannot decode music", path)
+        return None
+    hours, minutes, seconds = times[-1]
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def run_in_threads(function, items, workers):
+    queue = Queue.Queue()
+    for item in items:
+        queue.put(item)
+    failures = []
+
+    def worker():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                function(item)
+            except Exception as e:
+                warning("Failed", item, repr(e))
+                failures.append((item, e))
+
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, queue.qsize()))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failures
+
+
+def measure_lengths(starts, metadata, workers=None):
+    # decode every converted file that has no decoded duration cached yet, one ffmpeg process per CPU
+    import multiprocessing
+    paths = [os.path.join(directory, "music", start.music_key + ".mp3") for start in starts]
+    paths = [path for path in paths if os.path.exists(path)]
+    run_in_threads(lambda path: metadata.get(path, decode=True), paths, workers or multiprocessing.cpu_count())
+
+
+def read_time(start, metadata):
     music_path = os.path.join(directory, "music", start.music_key + ".mp3")
     if os.path.exists(music_path):
-        mp3_file = eyed3.load(music_path)
-        start.music_length = mp3_file.info.time_secs
-
-
-# convert entries spreadsheet to events spreadsheet format
-def normalize_event_name(event):
-    if "(Male)" in event:
-        event = event.replace(" (Male)", "")
-        male_event = True
-    elif "(Men)" in event:
-        event = event.replace(" (Men)", "")
-        male_event = True
+        entry = metadata.get(music_path)
+        start.music_length = int(round(entry.get("decoded_duration") or entry["duration"]))
+
+
+def length_status(start, tolerance=0):
+    if start.music_length > 0 and start.event.has_submitted_music:
+        if start.event.min_music_length and start.music_length < start.event.min_music_length - tolerance:
+            return "under"
+        if start.event.max_music_length and start.music_length > start.event.max_music_length + tolerance:
+            return "over"
+        return "ok"
+    return ""
+
+
+def check_lengths(starts, tolerance=0, table=None):
+    if table:
+        for start in table.starts:
+            start.length_status = "ok" if start.music_length > 0 and start.event.has_submitted_music else ""
+        under, over = table.length_violations(tolerance)
+        for i in under:
+            table.starts[i].length_status = "under"
+        for i in over:
+            table.starts[i].length_status = "over"
     else:
-        male_event = False
-
-    if "Short Program" in event:
-        level = event.split()[0]
-        if male_event:
-            return level + " Mens Short Program"
-        else:
-            return level + " Ladies Short Program"
-    elif "Excel" in event or "Championship" in event:
-        if male_event:
-            return event + " Mens Freeskate"
-        else:
-            return event + " Ladies Freeskate"
-    elif "Pattern Dance" in event:
-        level = event.split()[0]
-        return level + " Solo Pattern Dance"
-    else:  # Team Maneuvers or Solo Free Dance
-        return event
+        for start in starts:
+            start.length_status = length_status(start, tolerance)
+    for start in starts:
+        if start.confirmed and start.length_status in ["under", "over"]:
+            warning("Music length " + start.length_status, start.music_key, format_time(start.music_length),
+                    format_time(start.event.min_music_length), format_time(start.event.max_music_length))
+
+
+class MusicLibrary(object):
+    """Indexes and caches over data/music_raw and data/music shared by the download and conversion stages.
+
+    In a workspace, store is the MusicStore shared with the other competitions.
+    """
+
+    def __init__(self, normalize=False, store=None):
+        self.normalize = normalize
+        self.store = store
+        self.raw_index = MusicIndex("music_raw")
+        self.transcodes = TranscodeCache()
+        self.metadata = MetadataCache()
+        self.loudness = LoudnessCache()
+
+    def transcode_args(self, source_hash):
+        if self.normalize:
+            measurement = self.loudness.get(source_hash)
+            if measurement:
+                return normalize_args(measurement) + TRANSCODE_ARGS
+        return TRANSCODE_ARGS
+
+    def save(self):
+        self.transcodes.save()
+        self.metadata.save()
+        self.loudness.save()
+
+
+GENDER_MARKERS = {
+    "Female": ["Ladies", "(Ladies)", "(Female)", "(Women)"],
+    "Male": ["Mens", "(Male)", "(Men)", "(Mens)"],
+}
+
+
+def event_aliases(event):
+    # every name the entries and updated entries spreadsheets use for an event
+    names = [event.level + " " + event.category, event.short_name]
+    if event.category == "Freeskate":
+        names.append(event.level)  # Excel and Championship levels are freeskates
+    if event.category == "Short Program":
+        names.append(event.level + " Championship Short Program")
+    aliases = [event.name]
+    for name in names:
+        aliases.append(name)
+        for gender in [event.gender] if event.gender else ["Female", "Male"]:
+            for marker in GENDER_MARKERS[gender]:
+                aliases.append(name + " " + marker)
+                if not marker.startswith("("):
+                    aliases.append(event.level + " " + marker + name[len(event.level):])
+    return aliases
+
+
+def level_first_name(name):
+    # short programs and pattern dances have also been entered as the level followed by anything, like
+    # "Preliminary Pattern Dance - Canasta Tango", only the first word and the category count then
+    for category in ["Short Program", "Pattern Dance"]:
+        if category in name:
+            return name.split()[0] + " " + category
+    return None
 
 
-def read_entries(events_by_name):
+class EventNames(object):
+    """Maps the event names used in the entries spreadsheets to events, built from the aliases of each event.
+
+    Lookups ignore case and punctuation and are memoized. A name without a gender marker, like "Excel Preliminary",
+    is an alias of both the Ladies and Mens event, and resolves by the gender of the row (Ladies if unknown).
+    """
+
+    def __init__(self, events):
+        self.events = events
+        self.aliases = collections.defaultdict(dict)
+        self.lookups = {}
+        for event in events:
+            for alias in event_aliases(event):
+                self.aliases[name_key(alias)][event.gender] = event
+
+    def find(self, name, gender=""):
+        lookup = (name, gender)
+        if lookup not in self.lookups:
+            events = self.aliases.get(name_key(name), {})
+            if not events and level_first_name(name):
+                events = self.aliases.get(name_key(level_first_name(name)), {})
+                if any(marker in name for marker in GENDER_MARKERS["Male"] if marker.startswith("(")):
+                    gender = "Male"
+            if len(events) == 1:
+                event = events.values()[0]
+            else:
+                event = events.get(gender) or events.get("Female")
+            self.lookups[lookup] = event
+        return self.lookups[lookup]
+
+    def suggest(self, name):
+        import difflib
+        keys = difflib.get_close_matches(name_key(name), self.aliases.keys(), 3)
+        suggestions = []
+        for key in keys:
+            for event in self.aliases[key].values():
+                if event.name not in suggestions:
+                    suggestions.append(event.name)
+        return suggestions
+
+
+def read_entries(event_names):
     skaters = Skaters()
-    with open(os.path.join(directory, "entries.csv"), "r") as file_in:
-        reader = csv.DictReader(file_in)
-        for row in reader:
-            raw_event = row["Event"].title().strip()
-            event = events_by_name[normalize_event_name(raw_event)]
-            if event.gender:
-                assert event.gender == row["Gender"]
-            usfs_number = row["USF #"].strip()
-            first_name = row["First Name"].strip().title()
-            last_name = row["Last Name"].strip().title()
-            email = row["E-mail"].strip()
-            skater = skaters.find_or_create(usfs_number, first_name, last_name, email)
-            skater.university = row["University"].strip().title()
-            Start(skater, event)
+    for i, line, row in read_sheet(os.path.join(directory, "entries.csv"), ENTRIES_SCHEMA):
+        event = event_names.find(row["Event"], row["Gender"])
+        if not event:
+            input_errors.add(ENTRIES_SCHEMA.name, line, "Unknown event", row["Event"], "did you mean",
+                             event_names.suggest(row["Event"]))
+            continue
+        if event.gender and event.gender != row["Gender"]:
+            input_errors.add(ENTRIES_SCHEMA.name, line, "Gender", row["Gender"], "does not match event", event.name)
+            continue
+        skater = skaters.find_or_create(row["USF #"], row["First Name"], row["Last Name"], row["E-mail"])
+        skater.university = row["University"]
+        Start(skater, event)
     return skaters
 
 
@@ -352,117 +1437,215 @@ def format_time(seconds):
     return str(datetime.timedelta(seconds=seconds))[3:]
 
 
-def generate_report(events, include_details):
-    if include_details:
-        output_path = os.path.join(directory, "music", "index.html")
-    else:
-        output_path = os.path.join(directory, "index.html")
-    with open("template.html", "r") as template, open(output_path, "w") as file_out:
-        for row in template:
-            if row == "<!--TIMESTAMP-->\n":
-                file_out.write("<p>Last Updated: ")
-                file_out.write(datetime.datetime.now().strftime("%A, %B %d %I:%M %P"))
-                file_out.write("</p>\n")
-            elif row == "<!--CONTENT-->\n":
-                if include_details:
-                    file_out.write("<h2>National Anthem</h2>\n")
-                    file_out.write("<a href='anthem.m4a'>Anthem</a>")
-                for event in events:
-                    confirmed_starts = [start for start in event.starts if start.confirmed]
-                    if not confirmed_starts:
-                        continue
-                    file_out.write("<h2>" + event.name + "</h2>\n")
-                    if event.dance:
-                        file_prefix = event.dance.lower().replace(" ", "_") + "_"
-                        file_out.write("<div class='dance-music'>")
-                        file_out.write(event.dance)
-                        file_out.write("<ul>")
-                        file_out.write("<li><a href='" + file_prefix + "0.mp3'>Warmup</a></li>")
-                        for i in range(1, 6):
-                            file_out.write("<li><a href='" + file_prefix + str(i) + ".mp3'>Track " + str(i) + "</a></li>")
-                        file_out.write("</ul>")
-                        file_out.write("</div>")
-                    if event.has_submitted_music:
-                        file_out.write("<div class='time'>")
-                        file_out.write("Program Length: ")
-                        if event.min_music_length:
-                            file_out.write("Min " + format_time(event.min_music_length) + " ")
-                        if event.max_music_length:
-                            file_out.write("Max " + format_time(event.max_music_length))
-                        file_out.write("</div>\n")
-                    file_out.write("<div>Entries below are NOT in starting order.</div>")
-                    file_out.write("<table>\n")
-                    file_out.write("<tr>\n")
-                    file_out.write("<th>Skater</th>\n")
-                    file_out.write("<th>University</th>\n")
-                    if event.has_submitted_music:
-                        file_out.write("<th>Music Length</th>\n")
-                        file_out.write("<th>Submit Count</th>\n")
-                        if include_details:
-                            file_out.write("<th>Music</th>\n")
-                            file_out.write("<th>Notes</th>\n")
-                    file_out.write("</tr>\n")
-
-                    for start in sorted(confirmed_starts, key=lambda s: s.skater.full_name):
-                        university = start.skater.university
-                        scratch = False
-                        skater = start.skater.full_name
-                        music_length = ""
-                        music = ""
-                        submit_count = str(len(start.music_submissions))
-                        if start.music_length > 0:
-                            music_length = format_time(start.music_length)
-                            music = "<a href=" + start.music_key + ".mp3>mp3</a>"
-                        if scratch:
-                            file_out.write("<tr class='scratch'>\n")
-                        else:
-                            file_out.write("<tr>\n")
-                        file_out.write("<td>" + skater + "</td>\n")
-                        file_out.write("<td>" + university + "</td>\n")
-                        if event.has_submitted_music:
-                            file_out.write("<td>" + music_length + "</td>\n")
-                            file_out.write("<td>" + submit_count + "</td>\n")
-                            if include_details:
-                                file_out.write("<td>" + music + "</td>\n")
-                                file_out.write("<td>" + cgi.escape(start.skater.notes) + "</td>\n")
-                        file_out.write("</tr>\n")
-
-                    file_out.write("</table>\n")
-            else:
-                file_out.write(row)
+TEMPLATE_MARKERS = {
+    "<!--TIMESTAMP-->": "timestamp",
+    "<!--CONTENT-->": "content",
+}
 
+template_cache = {}
 
-def read_updated_entries(skaters, events_by_name):
-    with open(os.path.join(directory, "updated_entries.csv"), "r") as file_in:
-        reader = csv.DictReader(file_in)
-        event = None
-        for row in reader:
-            name = " ".join(row["Name"].split()).title()  # clean up whitespace
-            university = row["University"].strip().title()
-            if name:
-                if university:
-                    if event.category != "Team Maneuvers":
-                        skater = skaters.find_by_name_and_university(name, university)
-                        if not skater:
-                            # TODO handle this case
-                            print ("Unknown Skater", name, university, event.name)
-                            raise ValueError()
-                        for start in skater.starts:
-                            if start.event == event:
-                                start.confirmed = True
-                                break
-                        else:
-                            start = Start(skater, event)
+
+def parse_template(path="template.html"):
+    # split the template into text and marker segments once, and again only if the file changes. Keyed by
+    # absolute path, as each competition of a workspace has its own template.html in its own directory
+    path = os.path.abspath(path)
+    signature = file_signature(path)
+    if path in template_cache and template_cache[path][0] == signature:
+        return template_cache[path][1]
+    segments = []
+    text = []
+    with open(path, "r") as template:
+        for row in template:
+            marker = TEMPLATE_MARKERS.get(row.strip())
+            if marker:
+                segments.append(("text", "".join(text)))
+                segments.append(("marker", marker))
+                text = []
+            else:
+                text.append(row)
+    segments.append(("text", "".join(text)))
+    template_cache[path] = (signature, segments)
+    return segments
+
+
+def report_events(events, table=None):
+    report = []
+    rosters = table.rosters() if table else {}
+    for i, event in enumerate(events):
+        if table:
+            confirmed_starts = rosters.get(i, [])
+        else:
+            confirmed_starts = [start for start in event.starts if start.confirmed]
+        if confirmed_starts:
+            report.append((event, sorted(confirmed_starts, key=lambda s: s.skater.full_name)))
+    return report
+
+
+def render_html_content(report):
+    # build the public and detailed pages together, detailed gets everything public gets plus extra columns
+    import cgi
+    public = []
+    detailed = ["<h2>National Anthem</h2>\n", "<a href='anthem.m4a'>Anthem</a>"]
+
+    def write(text):
+        public.append(text)
+        detailed.append(text)
+
+    for event, starts in report:
+        write("<h2>" + event.name + "</h2>\n")
+        if event.dance:
+            file_prefix = event.dance.lower().replace(" ", "_") + "_"
+            write("<div class='dance-music'>")
+            write(event.dance)
+            write("<ul>")
+            write("<li><a href='" + file_prefix + "0.mp3'>Warmup</a></li>")
+            for i in range(1, 6):
+                write("<li><a href='" + file_prefix + str(i) + ".mp3'>Track " + str(i) + "</a></li>")
+            write("</ul>")
+            write("</div>")
+        if event.has_submitted_music:
+            write("<div class='time'>")
+            write("Program Length: ")
+            if event.min_music_length:
+                write("Min " + format_time(event.min_music_length) + " ")
+            if event.max_music_length:
+                write("Max " + format_time(event.max_music_length))
+            write("</div>\n")
+        write("<div>Entries below are NOT in starting order.</div>")
+        write("<table>\n")
+        write("<tr>\n")
+        write("<th>Skater</th>\n")
+        write("<th>University</th>\n")
+        if event.has_submitted_music:
+            write("<th>Music Length</th>\n")
+            write("<th>Submit Count</th>\n")
+            detailed.append("<th>Music</th>\n")
+            detailed.append("<th>Notes</th>\n")
+        write("</tr>\n")
+
+        for start in starts:
+            university = start.skater.university
+            scratch = False
+            skater = start.skater.full_name
+            music_length = ""
+            music = ""
+            submit_count = str(len(start.music_submissions))
+            if start.music_length > 0:
+                music_length = format_time(start.music_length)
+                music = "<a href=" + start.music_key + ".mp3>mp3</a>"
+            if scratch:
+                write("<tr class='scratch'>\n")
+            else:
+                write("<tr>\n")
+            write("<td>" + skater + "</td>\n")
+            write("<td>" + university + "</td>\n")
+            if event.has_submitted_music:
+                if start.length_status in ["under", "over"]:
+                    write("<td class='" + start.length_status + "'>" + music_length + " (" + start.length_status +
+                          ")</td>\n")
+                else:
+                    write("<td>" + music_length + "</td>\n")
+                write("<td>" + submit_count + "</td>\n")
+                detailed.append("<td>" + music + "</td>\n")
+                detailed.append("<td>" + cgi.escape(start.skater.notes) + "</td>\n")
+            write("</tr>\n")
+
+        write("</table>\n")
+    return "".join(public), "".join(detailed)
+
+
+def fill_template(content):
+    markers = {
+        "timestamp": "<p>Last Updated: " + datetime.datetime.now().strftime("%A, %B %d %I:%M %P") + "</p>\n",
+        "content": content,
+    }
+    return "".join(markers[value] if kind == "marker" else value for kind, value in parse_template())
+
+
+def write_html_reports(report):
+    public, detailed = render_html_content(report)
+    write_file(os.path.join(directory, "music", "index.html"), fill_template(detailed))
+    write_file(os.path.join(directory, "index.html"), fill_template(public))
+
+
+def report_rows(report):
+    for event, starts in report:
+        for start in starts:
+            yield {
+                "event": event.name,
+                "skater": start.skater.full_name,
+                "university": start.skater.university,
+                "music_length": start.music_length,
+                "length_status": start.length_status,
+                "submit_count": len(start.music_submissions),
+                "music": start.music_key + ".mp3" if start.music_length > 0 else "",
+                "notes": start.skater.notes,
+            }
+
+
+REPORT_COLUMNS = ["event", "skater", "university", "music_length", "length_status", "submit_count", "music", "notes"]
+
+
+def write_json_report(report):
+    rows = list(report_rows(report))
+    write_file(os.path.join(directory, "music", "report.json"), json.dumps(rows, indent=1, sort_keys=True))
+
+
+def write_csv_report(report):
+    buffer = StringIO.StringIO()
+    writer = csv.DictWriter(buffer, REPORT_COLUMNS)
+    writer.writeheader()
+    writer.writerows(report_rows(report))
+    write_file(os.path.join(directory, "music", "report.csv"), buffer.getvalue())
+
+
+REPORT_FORMATS = {
+    "html": write_html_reports,
+    "json": write_json_report,
+    "csv": write_csv_report,
+}
+
+
+def generate_reports(events, formats, table=None):
+    report = report_events(events, table)
+    for report_format in formats:
+        REPORT_FORMATS[report_format](report)
+
+
+def read_updated_entries(skaters, event_names):
+    event = None
+    for i, line, row in read_sheet(os.path.join(directory, "updated_entries.csv"), UPDATED_ENTRIES_SCHEMA):
+        name = row["Name"]
+        university = row["University"]
+        if name:
+            if university:
+                if not event:
+                    input_errors.add(UPDATED_ENTRIES_SCHEMA.name, line, "No event for", name, university)
+                elif event.category != "Team Maneuvers":
+                    skater = skaters.find_by_name_and_university(name, university)
+                    if not skater:
+                        input_errors.add(UPDATED_ENTRIES_SCHEMA.name, line, "Unknown Skater", name, university,
+                                         event.name)
+                        continue
+                    for start in skater.starts:
+                        if start.event == event:
                             start.confirmed = True
-                            print ("Created new start", start, skater.starts)
-                else:  # event header row
-                    event = events_by_name[normalize_event_name(name)]
+                            break
+                    else:
+                        start = Start(skater, event)
+                        start.confirmed = True
+                        print ("Created new start", start, skater.starts)
+            else:  # event header row
+                event = event_names.find(name)
+                if not event:
+                    input_errors.add(UPDATED_ENTRIES_SCHEMA.name, line, "Unknown event", name, "did you mean",
+                                     event_names.suggest(name))
 
 
-def print_counts(events, print_missing):
+def count_submissions(events):
     submitted = 0
     total = 0
-    missing_skaters = set()
+    missing = collections.OrderedDict()
     for event in events:
         if event.has_submitted_music:
             for start in event.starts:
@@ -471,17 +1654,24 @@ def print_counts(events, print_missing):
                     if start.music_submissions:
                         submitted += 1
                     else:
-                        missing_skaters.add(start.skater)
+                        missing.setdefault(start.skater, []).append(start)
+    return submitted, total, missing
+
+
+def print_counts(events, print_missing, table=None):
+    if table:
+        submitted, total, missing = table.count_submissions()
+    else:
+        submitted, total, missing = count_submissions(events)
     if print_missing:
-        for skater in missing_skaters:
+        for skater, starts in missing.items():
             print (skater.full_name, skater.email, skater.university)
-            for start in skater.starts:
-                if not start.music_submissions and start.confirmed and start.event.has_submitted_music:
-                    print start.event.name
+            for start in starts:
+                print start.event.name
 
     print ("Submitted", submitted, "Total", total)
-    print ("Missing Entries", total - submitted, "Missing Skaters", len(missing_skaters))
-    print ("Missing Emails", [skater.email for skater in missing_skaters])
+    print ("Missing Entries", total - submitted, "Missing Skaters", len(missing))
+    print ("Missing Emails", [skater.email for skater in missing])
 
 
 def debug_skater(skaters, name):
@@ -492,49 +1682,1302 @@ def debug_skater(skaters, name):
         print start.last_music_submission()
 
 
+########################
+# LOUDNESS AND SILENCE #
+########################
+
+# trim silence from both ends, reversing the audio to trim the end, then normalize to EBU R128
+SILENCE_FILTER = ("silenceremove=start_periods=1:start_threshold=-50dB,areverse,"
+                  "silenceremove=start_periods=1:start_threshold=-50dB,areverse")
+LOUDNORM_TARGET = "I=-16:TP=-1.5:LRA=11"
+
+
+def measure_loudness(path):
+    # first loudnorm pass, only measures the trimmed audio and prints the measurement as JSON
+    import subprocess
+    with open(os.devnull, "r") as devnull, stats.timed_span(os.path.basename(path), "loudness_seconds"):
+        process = subprocess.Popen(
+            ["ffmpeg", "-i", path, "-af", SILENCE_FILTER + ",loudnorm=" + LOUDNORM_TARGET + ":print_format=json",
+             "-f", "null", "-"],
+            stdin=devnull, stdout=devnull, stderr=subprocess.PIPE)
+        stderr = process.communicate()[1]
+    measurement = stderr[stderr.rfind("{"):stderr.rfind("}") + 1]
+    if process.returncode != 0 or not measurement:
+        warning("Cannot measure loudness", path)
+        return None
+    return json.loads(measurement)
+
+
+def normalize_args(measurement):
+    # second loudnorm pass, applies the measured values linearly and resamples back from loudnorm's 192kHz
+    loudnorm = "loudnorm={}:measured_I={}:measured_TP={}:measured_LRA={}:measured_thresh={}:offset={}".format(
+        LOUDNORM_TARGET, measurement["input_i"], measurement["input_tp"], measurement["input_lra"],
+        measurement["input_thresh"], measurement["target_offset"])
+    return ["-af", SILENCE_FILTER + "," + loudnorm + ":linear=true", "-ar", "44100"]
+
+
+class LoudnessCache(object):
+    """Loudness measurements of raw music, persisted in data/loudness_cache.json and keyed by source hash."""
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(directory, "loudness_cache.json")
+        self.lock = threading.Lock()
+        self.measurements = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as file_in:
+                self.measurements = json.load(file_in)
+
+    def get(self, source_hash):
+        with self.lock:
+            return self.measurements.get(source_hash)
+
+    def set(self, source_hash, measurement):
+        if measurement:
+            with self.lock:
+                self.measurements[source_hash] = measurement
+
+    def save(self):
+        with self.lock:
+            write_json(self.path, self.measurements)
+
+
+def analyse_loudness(starts, library, workers):
+    # measure every raw file not measured before, unchanged files keep their cached measurement
+    sources = {}
+    for start in starts:
+        if start.music_submissions:
+            input_file_name = get_cached_music(start, library.raw_index)
+            if input_file_name:
+                input_path = os.path.join(directory, "music_raw", input_file_name)
+                source_hash = library.transcodes.source_hash(input_path)
+                if not library.loudness.get(source_hash):
+                    sources[source_hash] = input_path
+    run_in_threads(lambda source: library.loudness.set(source[0], measure_loudness(source[1])),
+                   sources.items(), workers)
+    library.loudness.save()
+
+
+################
+# FINGERPRINTS #
+################
+
+FINGERPRINT_RATE = 5512
+# energies are summed over hop blocks, a frame is FINGERPRINT_FRAME / FINGERPRINT_HOP consecutive blocks
+FINGERPRINT_FRAME = 1024
+FINGERPRINT_HOP = 256
+# band energies are estimated from every 4th sample, splitting the interleaved bands is the slow part
+FINGERPRINT_DECIMATION = 4
+# 33 log spaced bands between 300 and 2000 Hz give 32 bits, one word per frame
+FINGERPRINT_EDGES = [300 * (2000.0 / 300) ** (i / 33.0) for i in range(34)]
+# only every FINGERPRINT_STRIDE-th word is indexed, queries look up all of theirs
+FINGERPRINT_STRIDE = 8
+FINGERPRINT_MIN_VOTES = 3
+# frames two fingerprints must overlap by, about ten seconds
+FINGERPRINT_MIN_OVERLAP = 200
+FINGERPRINT_MAX_BIT_ERRORS = 0.35
+# bits set in each 16 bit value, built by popcount_table on the first comparison
+popcount = None
+
+
+def popcount_table():
+    global popcount
+    if popcount is None:
+        popcount = bytearray(bin(i).count("1") for i in range(1 << 16))
+    return popcount
+
+
+def fingerprint_filter():
+    # split the decoded audio into one channel per band, so ffmpeg does all the filtering in one pass
+    bands = len(FINGERPRINT_EDGES) - 1
+    graph = ["[0:a]aformat=channel_layouts=mono,aresample={},asplit={}{}".format(
+        FINGERPRINT_RATE, bands, "".join("[s{}]".format(i) for i in range(bands)))]
+    for i in range(bands):
+        low, high = FINGERPRINT_EDGES[i], FINGERPRINT_EDGES[i + 1]
+        graph.append("[s{0}]bandpass=f={1:.1f}:width_type=h:w={2:.1f}[b{0}]".format(i, (low * high) ** 0.5,
+                                                                                   high - low))
+    graph.append("".join("[b{}]".format(i) for i in range(bands)) + "amerge=inputs={}[out]".format(bands))
+    return ";".join(graph)
+
+
+def fingerprint_words(band_energies):
+    # column at a time like StartTable: block energies to frame energies to differences of neighbouring
+    # bands, then bit b of frame n is set when the difference of bands b and b + 1 grew since frame n - 1
+    blocks_per_frame = FINGERPRINT_FRAME // FINGERPRINT_HOP
+    frames = []
+    for energies in band_energies:
+        count = len(energies) - blocks_per_frame + 1
+        frame = energies[:count]
+        for i in range(1, blocks_per_frame):
+            frame = map(operator.add, frame, energies[i:i + count])
+        frames.append(frame)
+    differences = [map(operator.sub, frames[b], frames[b + 1]) for b in range(len(frames) - 1)]
+    words = [0] * max(0, len(frames[0]) - 1)
+    for b, difference in enumerate(differences):
+        bits = map(operator.gt, difference[1:], difference[:-1])
+        words = map(operator.or_, words, map(operator.lshift, bits, itertools.repeat(b, len(bits))))
+    return array.array("I", words)
+
+
+def fingerprint(path):
+    """Chromaprint style fingerprint of path, one 32 bit word per frame, or None if ffmpeg cannot decode it."""
+    import audioop
+    import subprocess
+    bands = len(FINGERPRINT_EDGES) - 1
+    block_size = FINGERPRINT_HOP * bands * 2
+    # many blocks are read at once so each band is split out of the interleaved samples once per chunk
+    chunk_blocks = 64
+    band_energies = [[] for _ in range(bands)]
+    with open(os.devnull, "r") as devnull, stats.timed_span(os.path.basename(path), "fingerprint_seconds"):
+        process = subprocess.Popen(
+            ["ffmpeg", "-v", "error", "-i", path, "-filter_complex", fingerprint_filter(), "-map", "[out]",
+             "-f", "s16le", "-acodec", "pcm_s16le", "-"],
+            stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        while True:
+            chunk = process.stdout.read(block_size * chunk_blocks)
+            blocks = len(chunk) // block_size
+            samples = array.array("h", chunk[:blocks * block_size])
+            block_bytes = FINGERPRINT_HOP // FINGERPRINT_DECIMATION * 2
+            offsets = range(0, blocks * block_bytes, block_bytes)
+            for b in range(bands):
+                channel = samples[b::bands * FINGERPRINT_DECIMATION].tostring()
+                blocks_rms = map(audioop.rms, map(buffer, itertools.repeat(channel, blocks), offsets,
+                                                  itertools.repeat(block_bytes, blocks)),
+                                 itertools.repeat(2, blocks))
+                band_energies[b].extend(map(operator.mul, blocks_rms, blocks_rms))
+            if blocks < chunk_blocks:
+                break
+        stderr = process.communicate()[1]
+    if process.returncode != 0 or len(band_energies[0]) <= FINGERPRINT_FRAME // FINGERPRINT_HOP:
+        warning("Cannot fingerprint", path, stderr.strip()[-200:])
+        return None
+    return fingerprint_words(band_energies)
+
+
+def bit_error_rate(words, other_words, offset):
+    # fraction of differing bits where words[i] lines up with other_words[i + offset], None if they barely overlap
+    first = max(0, -offset)
+    last = min(len(words), len(other_words) - offset)
+    if last - first < FINGERPRINT_MIN_OVERLAP:
+        return None
+    table = popcount_table()
+    errors = 0
+    for i in range(first, last):
+        difference = words[i] ^ other_words[i + offset]
+        errors += table[difference & 0xffff] + table[difference >> 16]
+    return errors / (32.0 * (last - first))
+
+
+class FingerprintIndex(object):
+    """Inverted index from fingerprint words to where they occur, for finding music similar to a fingerprint.
+
+    A query collects votes for (fingerprint, alignment) pairs from its exactly matching words and then
+    checks the bit error rate of the best aligned candidates, so only a handful of full comparisons run
+    however many fingerprints are indexed.
+    """
+
+    def __init__(self):
+        self.fingerprints = {}
+        self.positions = collections.defaultdict(list)
+
+    def add(self, key, words):
+        self.fingerprints[key] = words
+        for position in range(0, len(words), FINGERPRINT_STRIDE):
+            # silence and constant tones give the same words in every track
+            if words[position] not in (0, 0xffffffff):
+                self.positions[words[position]].append((key, position))
+
+    def matches(self, key, words):
+        """Keys of the indexed fingerprints that sound like words, with their bit error rates."""
+        votes = collections.Counter()
+        for position, word in enumerate(words):
+            for other_key, other_position in self.positions.get(word, ()):
+                if other_key != key:
+                    votes[(other_key, other_position - position)] += 1
+        matches = {}
+        for (other_key, offset), count in votes.most_common():
+            if count < FINGERPRINT_MIN_VOTES:
+                break
+            if other_key not in matches:
+                error_rate = bit_error_rate(words, self.fingerprints[other_key], offset)
+                if error_rate is not None and error_rate <= FINGERPRINT_MAX_BIT_ERRORS:
+                    matches[other_key] = error_rate
+        return matches
+
+
+class FingerprintCache(object):
+    """Fingerprints of converted music in data/fingerprints/<hash>.fp, keyed by the hash of the raw source.
+
+    data/fingerprints/history.json remembers which submission of each start was fingerprinted with which
+    hash, so a new submission can be compared with the one it replaces.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(directory, "fingerprints")
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.history_path = os.path.join(self.path, "history.json")
+        self.history = {}
+        if os.path.exists(self.history_path):
+            with open(self.history_path, "r") as file_in:
+                self.history = json.load(file_in)
+
+    def get(self, key):
+        path = os.path.join(self.path, key + ".fp")
+        if not os.path.exists(path):
+            return None
+        words = array.array("I")
+        with open(path, "rb") as file_in:
+            words.fromstring(file_in.read())
+        return words
+
+    def compute(self, key, music_path):
+        words = fingerprint(music_path)
+        if words is not None:
+            write_file(os.path.join(self.path, key + ".fp"), words.tostring())
+            stats.count("fingerprints")
+
+    def save(self):
+        write_json(self.history_path, self.history)
+
+
+def fingerprint_key(start, library):
+    # None until the converted file comes from the last submission, an older conversion left in place by a
+    # failed download or conversion would otherwise look like a resubmission of the same music
+    output = library.transcodes.outputs.get(start.music_key + ".mp3")
+    music_stem = str(start.last_music_submission().index) + "_" + start.music_key
+    if output and os.path.splitext(output["source"])[0] == music_stem:
+        return output["source_hash"]
+    return None
+
+
+def check_fingerprints(starts, library, workers=None):
+    """Warn about starts with the same or very similar music, and about resubmissions of the same music.
+
+    Each distinct source is decoded once, later runs reuse the cached fingerprint.
+    """
+    import multiprocessing
+    cache = FingerprintCache()
+    keys = {}
+    for start in starts:
+        if start.music_submissions and os.path.exists(os.path.join(directory, "music", start.music_key + ".mp3")):
+            key = fingerprint_key(start, library)
+            if key:
+                keys[start] = key
+    missing = {}
+    for start, key in keys.items():
+        if key not in missing and cache.get(key) is None:
+            missing[key] = os.path.join(directory, "music", start.music_key + ".mp3")
+    run_in_threads(lambda item: cache.compute(*item), missing.items(), workers or multiprocessing.cpu_count())
+
+    index = FingerprintIndex()
+    starts_by_key = collections.defaultdict(list)
+    for start, key in keys.items():
+        starts_by_key[key].append(start)
+    for key in starts_by_key:
+        words = cache.get(key)
+        if words is not None:
+            index.add(key, words)
+
+    # identical sources, then similar ones, each pair of starts reported once
+    pairs = {}
+    for key, key_starts in starts_by_key.items():
+        for a, b in itertools.combinations(sorted(start.music_key for start in key_starts), 2):
+            pairs[(a, b)] = 0.0
+        if key in index.fingerprints:
+            for other_key, error_rate in index.matches(key, index.fingerprints[key]).items():
+                for start in key_starts:
+                    for other in starts_by_key[other_key]:
+                        pair = tuple(sorted([start.music_key, other.music_key]))
+                        pairs[pair] = min(error_rate, pairs.get(pair, 1.0))
+    for (a, b), error_rate in sorted(pairs.items()):
+        warning("Same music", a, b, round(error_rate, 3))
+    stats.count("fingerprint_collisions", len(pairs))
+
+    for start, key in sorted(keys.items(), key=lambda item: item[0].music_key):
+        submission_index = start.last_music_submission().index
+        history = cache.history.setdefault(start.music_key, [])
+        if history and history[-1][0] != submission_index:
+            previous_words = cache.get(history[-1][1])
+            words = index.fingerprints.get(key)
+            if previous_words is not None and words is not None:
+                previous = FingerprintIndex()
+                previous.add("previous", previous_words)
+                if history[-1][1] == key or previous.matches(key, words):
+                    warning("Resubmitted the same music", start.music_key, len(start.music_submissions))
+                    stats.count("fingerprint_resubmissions")
+        if not history or history[-1] != [submission_index, key]:
+            history.append([submission_index, key])
+    cache.save()
+
+
+######################
+# SHARED MUSIC STORE #
+######################
+
+
+def replace_with_link(source_path, target_path):
+    # hard links need both paths on one file system, False if they are not
+    temp_path = target_path + ".tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    try:
+        os.link(source_path, temp_path)
+    except (AttributeError, OSError):
+        return False
+    os.rename(temp_path, target_path)
+    return True
+
+
+def link_or_copy(source_path, target_path):
+    if not replace_with_link(source_path, target_path):
+        shutil.copyfile(source_path, target_path + ".tmp")
+        os.rename(target_path + ".tmp", target_path)
+
+
+class MusicStore(object):
+    """Content addressed music shared by all competitions of a workspace.
+
+    Raw files are kept once per content hash in raw/, and competitions hard link their data/music_raw
+    files to them where the file system allows it. Converted music is kept once per content hash and ffmpeg
+    arguments in converted/, so a program submitted again for another competition or season is converted
+    only once. Tags differ per competition, so each competition tags its own copy of the converted file.
+
+    Converted music therefore takes the space it would without a store plus one copy per distinct
+    conversion. The converted files are small next to the raw wav and aiff uploads that are deduplicated,
+    and converted/ is only a cache: deleting it costs conversions, never music.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conversion_locks = {}
+        for subdir in ["raw", "converted"]:
+            if not os.path.exists(os.path.join(path, subdir)):
+                os.makedirs(os.path.join(path, subdir))
+
+    def add_raw(self, path, source_hash):
+        store_path = os.path.join(self.path, "raw", source_hash + os.path.splitext(path)[1].lower())
+        if not os.path.exists(store_path):
+            link_or_copy(path, store_path)
+            stats.count("store_raw_added")
+        elif not os.path.samefile(path, store_path):
+            # the store file is named by the hash of path, so its content is already the same and only a link
+            # saves space. Copying it over path instead would change the mtime and hash of the raw file
+            # again on every run.
+            if replace_with_link(store_path, path):
+                stats.count("store_raw_deduplicated")
+
+    def conversion_lock(self, key):
+        with self.lock:
+            return self.conversion_locks.setdefault(key, threading.Lock())
+
+    def transcode(self, transcode):
+        key = hashlib.sha1(json.dumps([transcode.source_hash, transcode.args])).hexdigest()
+        converted_path = os.path.join(self.path, "converted", key + ".mp3")
+        # two starts of one build may share a source, the second one waits for and reuses the first conversion
+        with self.conversion_lock(key):
+            if os.path.exists(converted_path):
+                stats.count("store_conversions_reused")
+            else:
+                part_path = os.path.join(self.path, "converted", key + ".part.mp3")
+                stored = Transcode(transcode.start, transcode.input_path, part_path, transcode.title,
+                                   transcode.album, transcode.source_hash, transcode.args)
+                converted = transcode_music(stored)
+                transcode.returncode = stored.returncode
+                transcode.stderr = stored.stderr
+                if not converted:
+                    return False
+                os.rename(part_path, converted_path)
+        # a copy rather than a link, tagging writes into the file
+        shutil.copyfile(converted_path, transcode.output_path)
+        transcode.returncode = 0
+        return True
+
+
+def competition_directories(workspace):
+    # every subdirectory with its own events.csv is a competition
+    return sorted(name for name in os.listdir(workspace)
+                  if os.path.isfile(os.path.join(workspace, name, "events.csv")))
+
+
+def use_competition(path):
+    # events.csv and template.html are read from the working directory, spreadsheets and music from data/
+    global directory
+    os.chdir(path)
+    directory = os.path.abspath("data")
+    for subdir in ["music_raw", "music"]:
+        if not os.path.exists(os.path.join(directory, subdir)):
+            os.makedirs(os.path.join(directory, subdir))
+
+
+#################
+# COLUMNAR VIEW #
+#################
+
+
+class StartTable(object):
+    """Column store over every start of a competition, for queries over the whole field at once.
+
+    Row i of each column describes starts[i], so the Start objects remain the object API over the same rows.
+    Columns are compact arrays and queries run as itertools/operator passes over whole columns instead of
+    nested loops over events, skaters and starts.
+    """
+
+    def __init__(self, events):
+        self.events = events
+        self.starts = [start for event in events for start in event.starts]
+        self.skaters = []
+        skater_rows = {}
+        self.event_index = array.array("i")
+        self.skater_index = array.array("i")
+        self.has_music = array.array("b")
+        self.min_length = array.array("d")
+        self.max_length = array.array("d")
+        self.event_rows = []
+        for i, event in enumerate(events):
+            count = len(event.starts)
+            self.event_rows.append((len(self.event_index), len(self.event_index) + count))
+            self.event_index.extend([i] * count)
+            self.has_music.extend([event.has_submitted_music] * count)
+            self.min_length.extend([event.min_music_length] * count)
+            self.max_length.extend([event.max_music_length] * count)
+        for start in self.starts:
+            if start.skater not in skater_rows:
+                skater_rows[start.skater] = len(self.skaters)
+                self.skaters.append(start.skater)
+            self.skater_index.append(skater_rows[start.skater])
+        self.refresh()
+
+    def refresh(self):
+        # columns that change as entries are confirmed and music arrives
+        self.confirmed = array.array("b", [start.confirmed for start in self.starts])
+        self.submission_count = array.array("i", [len(start.music_submissions) for start in self.starts])
+        self.music_length = array.array("d", [start.music_length for start in self.starts])
+
+    def rows(self, mask):
+        return itertools.compress(xrange(len(self.starts)), mask)
+
+    def count_submissions(self):
+        needs_music = map(operator.and_, self.confirmed, self.has_music)
+        submitted = map(operator.and_, needs_music, map(bool, self.submission_count))
+        missing = collections.OrderedDict()
+        for i in self.rows(map(operator.gt, needs_music, submitted)):
+            missing.setdefault(self.skaters[self.skater_index[i]], []).append(self.starts[i])
+        return sum(submitted), sum(needs_music), missing
+
+    def rosters(self):
+        # confirmed starts grouped by index of their event
+        rosters = collections.defaultdict(list)
+        for i in self.rows(self.confirmed):
+            rosters[self.event_index[i]].append(self.starts[i])
+        return rosters
+
+    def length_violations(self, tolerance=0):
+        # rows whose music is shorter than the event minimum or longer than the event maximum, only for
+        # events that take music, like length_status. The limits are the same over an event's block of rows,
+        # so each block is compared against two constants and events without music or limits are skipped.
+        under = []
+        over = []
+        for begin, end in self.event_rows:
+            if begin == end or not self.has_music[begin]:
+                continue
+            lengths = self.music_length[begin:end]
+            if self.min_length[begin]:
+                too_short = map(float(self.min_length[begin] - tolerance).__gt__, lengths)
+                under.extend(itertools.compress(xrange(begin, end),
+                                                map(operator.and_, map((0.0).__lt__, lengths), too_short)))
+            if self.max_length[begin]:
+                too_long = map(float(self.max_length[begin] + tolerance).__lt__, lengths)
+                over.extend(itertools.compress(xrange(begin, end), too_long))
+        return under, over
+
+
+######################
+# INCREMENTAL BUILDS #
+######################
+
+
+def file_signature(path):
+    if os.path.exists(path):
+        stat = os.stat(path)
+        return [stat.st_mtime, stat.st_size]
+    return None
+
+
+def build_inputs():
+    return {
+        "events.csv": "events.csv",
+        "template.html": "template.html",
+        "entries.csv": os.path.join(directory, "entries.csv"),
+        "updated_entries.csv": os.path.join(directory, "updated_entries.csv"),
+        "input.csv": os.path.join(directory, "input.csv"),
+        # directory mtimes change whenever files are added or removed
+        "music_raw": os.path.join(directory, "music_raw"),
+        "music": os.path.join(directory, "music"),
+    }
+
+
+def start_signature(start, library):
+    submission = start.last_music_submission()
+    if not submission:
+        return None
+    raw_file_name = get_cached_music(start, library.raw_index)
+    raw_signature = None
+    if raw_file_name:
+        raw_signature = file_signature(os.path.join(directory, "music_raw", raw_file_name))
+    output_signature = file_signature(os.path.join(directory, "music", start.music_key + ".mp3"))
+    return [submission.index, submission.url, len(start.music_submissions), raw_signature, output_signature]
+
+
+def event_signature(event):
+    rows = []
+    for start in event.starts:
+        if start.confirmed:
+            rows.append([start.skater.full_name, start.skater.university, start.skater.notes, start.music_key,
+                         start.music_length, start.length_status, len(start.music_submissions)])
+    rows.sort()
+    return [event.min_music_length, event.max_music_length, event.dance, rows]
+
+
+class BuildState(object):
+    """Signatures of the inputs, starts and events of the last build, persisted in data/build_state.json.
+
+    An incremental build stops early if no input file changed, processes only the starts whose submission,
+    raw file or converted file changed, and rewrites the reports only if some event's rows, the template or
+    the report formats changed.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(directory, "build_state.json")
+        self.inputs = {}
+        self.starts = {}
+        self.events = {}
+        self.report_formats = None
+        if os.path.exists(self.path):
+            with open(self.path, "r") as file_in:
+                data = json.load(file_in)
+            self.inputs = data["inputs"]
+            self.starts = data["starts"]
+            self.events = data["events"]
+            self.report_formats = data.get("report_formats")
+
+    def changed_inputs(self, report_formats):
+        signatures = {name: file_signature(path) for name, path in build_inputs().items()}
+        changed = sorted(name for name, signature in signatures.items() if self.inputs.get(name) != signature)
+        if self.report_formats != report_formats:
+            changed.append("report_formats")
+        return changed
+
+    def changed_starts(self, starts, library):
+        return [start for start in starts
+                if start.music_submissions and self.starts.get(start.music_key) != start_signature(start, library)]
+
+    def changed_events(self, events):
+        return [event for event in events if self.events.get(event.name) != event_signature(event)]
+
+    def update(self, starts, events, library, failed_starts, report_formats):
+        # inputs are only recorded after a complete build, and failed starts or starts still missing their raw
+        # or converted file get no signature, so the next run retries them
+        if not failed_starts:
+            self.inputs = {name: file_signature(path) for name, path in build_inputs().items()}
+        else:
+            self.inputs = {}
+        self.starts = {}
+        for start in starts:
+            signature = start_signature(start, library)
+            if start in failed_starts or (signature and (signature[3] is None or signature[4] is None)):
+                continue
+            self.starts[start.music_key] = signature
+        self.events = {event.name: event_signature(event) for event in events}
+        self.report_formats = report_formats
+
+    def save(self):
+        write_json(self.path, {"inputs": self.inputs, "starts": self.starts, "events": self.events,
+                               "report_formats": self.report_formats})
+
+
+class ModelSnapshot(object):
+    """Pickled events with their starts, skaters, submissions and music lengths, in data/model_snapshot.pickle.
+
+    The snapshot is valid while events.csv, the spreadsheets and the metadata cache it was taken from are
+    unchanged, so commands that only print counts or rewrite reports skip parsing the spreadsheets.
+    Length statuses are checked again after loading, with the tolerance of the command.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(directory, "model_snapshot.pickle")
+
+    def inputs(self):
+        paths = build_inputs()
+        del paths["music_raw"], paths["music"], paths["template.html"]
+        paths["metadata_cache.json"] = os.path.join(directory, "metadata_cache.json")
+        return {name: file_signature(path) for name, path in paths.items()}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "rb") as file_in:
+                # the input signatures are pickled first so a stale snapshot is rejected without loading the model
+                if cPickle.load(file_in) != self.inputs():
+                    return None
+                return cPickle.load(file_in)
+        except Exception as e:
+            print ("Ignoring unreadable snapshot", repr(e))
+            return None
+
+    def save(self, events):
+        write_file(self.path, cPickle.dumps(self.inputs(), cPickle.HIGHEST_PROTOCOL) +
+                   cPickle.dumps(events, cPickle.HIGHEST_PROTOCOL))
+
+
+def print_plan(changed_inputs, starts):
+    print ("Changed inputs", changed_inputs)
+    print ("Starts to update", len(starts))
+    for start in starts:
+        print ("Update", start.music_key)
+
+
+##########
+# EXPORT #
+##########
+
+
+def export_name(event):
+    return re.sub(r"\W+", "_", event.name)
+
+
+def dance_tracks(event):
+    # the same files and labels as the dance music links in the detailed report
+    file_prefix = event.dance.lower().replace(" ", "_") + "_"
+    yield file_prefix + "0.mp3", "Warmup"
+    for i in range(1, 6):
+        yield file_prefix + str(i) + ".mp3", "Track " + str(i)
+
+
+def playlist_tracks(event, starts, metadata):
+    """The event's music in running order, the dance tracks first and then one track for each start.
+
+    Starts without converted music keep their place with no file, so the announcer still sees them.
+    """
+    tracks = []
+    if event.dance:
+        for file_name, label in dance_tracks(event):
+            music_path = os.path.join(directory, "music", file_name)
+            if not os.path.exists(music_path):
+                warning("Missing dance music", event.name, file_name)
+                continue
+            entry = metadata.get(music_path)
+            tracks.append({"title": event.dance + " " + label, "skater": None, "university": None,
+                           "duration": int(round(entry.get("decoded_duration") or entry["duration"] or 0)),
+                           "file": file_name})
+    for start in starts:
+        tracks.append({"title": start.skater.full_name, "skater": start.skater.full_name,
+                       "university": start.skater.university, "duration": start.music_length,
+                       "file": start.music_key + ".mp3" if start.music_length > 0 else None})
+    for position, track in enumerate(tracks, 1):
+        track["position"] = position
+    return tracks
+
+
+def bundle_file_name(track):
+    # numbered so the running order survives players that sort by file name
+    return "{:02d}_{}".format(track["position"], track["file"])
+
+
+def render_playlists(event, tracks, file_path):
+    # file_path maps a track to the path written into the playlists
+    m3u = ["#EXTM3U"]
+    rows = []
+    for track in tracks:
+        row = dict(track, file=file_path(track) if track["file"] else None)
+        rows.append(row)
+        if row["file"]:
+            title = row["title"]
+            if row["university"]:
+                title += " - " + row["university"]
+            m3u.append("#EXTINF:{},{}".format(row["duration"], title))
+            m3u.append(row["file"])
+    playlist = {
+        "event": event.name,
+        "dance": event.dance,
+        "min_music_length": event.min_music_length,
+        "max_music_length": event.max_music_length,
+        "tracks": rows,
+    }
+    return "\n".join(m3u) + "\n", json.dumps(playlist, indent=1, sort_keys=True)
+
+
+def write_bundle(path, event, tracks):
+    # stored, not deflated, so the bundle is quick to write and players can read tracks straight out of it
+    import zipfile
+    m3u, playlist = render_playlists(event, tracks, bundle_file_name)
+    temp_path = path + ".tmp"
+    with zipfile.ZipFile(temp_path, "w", zipfile.ZIP_STORED, allowZip64=True) as bundle:
+        bundle.writestr("playlist.m3u", m3u)
+        bundle.writestr("playlist.json", playlist)
+        for track in tracks:
+            if track["file"]:
+                bundle.write(os.path.join(directory, "music", track["file"]), bundle_file_name(track))
+    os.rename(temp_path, path)
+
+
+def export_signature(tracks, bundle):
+    files = [file_signature(os.path.join(directory, "music", track["file"])) for track in tracks if track["file"]]
+    return hashlib.sha1(json.dumps([tracks, files, bundle], sort_keys=True)).hexdigest()
+
+
+def export_events(events, metadata, bundle=False, table=None):
+    """Write a running order playlist for each event to data/export, as M3U and JSON, and optionally a zip bundle.
+
+    Signatures of each event's tracks and music files are kept in data/export/export_state.json, so only
+    events that changed since the last export are written again.
+    """
+    export_directory = os.path.join(directory, "export")
+    if not os.path.exists(export_directory):
+        os.makedirs(export_directory)
+    state_path = os.path.join(export_directory, "export_state.json")
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path, "r") as file_in:
+            state = json.load(file_in)
+
+    signatures = {}
+    for event, starts in report_events(events, table):
+        name = export_name(event)
+        tracks = playlist_tracks(event, starts, metadata)
+        signatures[name] = export_signature(tracks, bundle)
+        paths = [os.path.join(export_directory, name + extension)
+                 for extension in [".m3u", ".json"] + ([".zip"] if bundle else [])]
+        if state.get(name) == signatures[name] and all(os.path.exists(path) for path in paths):
+            stats.count("exports_skipped")
+            continue
+        print ("Exporting", event.name)
+        # playlists next to the music directory refer to the converted files in place
+        m3u, playlist = render_playlists(event, tracks, lambda track: "../music/" + track["file"])
+        write_file(paths[0], m3u)
+        write_file(paths[1], playlist)
+        if bundle:
+            write_bundle(paths[2], event, tracks)
+        stats.count("exports")
+
+    for name in set(state) - set(signatures):
+        for extension in [".m3u", ".json", ".zip"]:
+            path = os.path.join(export_directory, name + extension)
+            if os.path.exists(path):
+                os.remove(path)
+    write_json(state_path, signatures)
+
+
+##############
+# WATCH MODE #
+##############
+
+
+def spreadsheet_url():
+    with open(os.path.join(directory, "key.txt"), "r") as key_file:
+        spreadsheet_key = key_file.read().strip()
+    # a full URL instead of a key points at any CSV export, such as a local stand-in server
+    if re.match(r"https?://", spreadsheet_key):
+        return spreadsheet_key
+    return "https://docs.google.com/spreadsheets/d/" + spreadsheet_key + "/export?format=csv"
+
+
+def changed_row_indexes(old_data, new_data):
+    """Indexes of the rows that are new or changed in new_data, the same indexes read_sheet yields.
+
+    None if rows were removed or the header changed, which can only be applied by reading the whole sheet.
+    """
+    # DictReader skips empty lines, so skip them here too to keep the indexes aligned
+    old_rows = [row for row in csv.reader(StringIO.StringIO(old_data)) if row]
+    new_rows = [row for row in csv.reader(StringIO.StringIO(new_data)) if row]
+    if not old_rows or not new_rows or old_rows[0] != new_rows[0] or len(new_rows) < len(old_rows):
+        return None
+    return set(i - 1 for i in range(1, len(new_rows)) if i >= len(old_rows) or old_rows[i] != new_rows[i])
+
+
+class SpreadsheetFetcher(object):
+    """Conditional downloads of the submissions spreadsheet into data/input.csv.
+
+    The ETag and Last-Modified of the last download are kept in data/input_sheet.json and sent back as
+    If-None-Match and If-Modified-Since, so polling an unchanged sheet costs a 304 without a body.
+    """
+
+    def __init__(self):
+        self.path = os.path.join(directory, "input.csv")
+        self.validators_path = os.path.join(directory, "input_sheet.json")
+        self.connections = HttpConnections()
+        self.validators = {}
+        if os.path.exists(self.validators_path):
+            with open(self.validators_path, "r") as file_in:
+                self.validators = json.load(file_in)
+
+    def fetch(self):
+        """Download the sheet if it changed. Returns (changed, row indexes) as changed_row_indexes does."""
+        headers = {}
+        # the validators only describe the cached copy while it is still there
+        if os.path.exists(self.path):
+            if self.validators.get("etag"):
+                headers["If-None-Match"] = self.validators["etag"]
+            if self.validators.get("last_modified"):
+                headers["If-Modified-Since"] = self.validators["last_modified"]
+        url, response = self.connections.get(spreadsheet_url(), headers)
+        data = response.read()
+        if response.status == 304:
+            stats.count("sheet_not_modified")
+            return False, set()
+        if response.status != 200:
+            raise IOError("HTTP error", response.status, response.reason, url)
+        stats.count("sheet_downloads")
+
+        old_data = ""
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as file_in:
+                old_data = file_in.read()
+        # only replace the cached copy if it changed, so watchers don't see a new mtime for the same rows
+        changed = data != old_data
+        indexes = set()
+        if changed:
+            indexes = changed_row_indexes(old_data, data)
+            write_file(self.path, data)
+        self.validators = {"etag": response.getheader("ETag"), "last_modified": response.getheader("Last-Modified")}
+        write_json(self.validators_path, self.validators)
+        return changed, indexes
+
+
+class SpreadsheetPoller(object):
+    """Fetches the submissions spreadsheet on a background thread every interval.
+
+    on_change is called with the indexes of the new or changed rows, or None if the whole sheet has to be
+    read again, whenever a poll downloads a sheet that differs from the cached copy.
+    """
+
+    def __init__(self, interval, on_change):
+        self.interval = interval
+        self.on_change = on_change
+        self.fetcher = SpreadsheetFetcher()
+        self.polls = 0
+        self.last_poll = None
+        self.last_error = None
+
+    def poll(self):
+        try:
+            changed, indexes = self.fetcher.fetch()
+            self.last_error = None
+        except Exception as e:
+            changed = False
+            self.last_error = repr(e)
+            print ("Failed to refresh spreadsheet", repr(e))
+        self.polls += 1
+        self.last_poll = datetime.datetime.now().isoformat()
+        if changed:
+            self.on_change(indexes)
+
+    def run(self):
+        while True:
+            self.poll()
+            time.sleep(self.interval)
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+
+class Watcher(object):
+    """Long running mode that rebuilds incrementally when spreadsheets or raw music in data/ change.
+
+    Changes are collected until the inputs have been quiet for the debounce period, then one incremental
+    build runs. The live spreadsheet is polled every sheet interval, and when only its rows changed the
+    model of the last build is kept and just the new or changed rows are applied to it. The queue of
+    pending changes and the last build are served as JSON on a local status port.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.args.incremental = True
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.changed_at = None
+        self.running = False
+        self.runs = 0
+        self.last_run = None
+        self.last_duration = None
+        self.last_error = None
+        self.model = None
+        # indexes of input.csv rows changed since the last build, None when the whole sheet must be read
+        self.sheet_rows = set()
+        self.poller = None
+
+    def snapshot(self):
+        signatures = {"events.csv": file_signature("events.csv"), "template.html": file_signature("template.html")}
+        for file_name in os.listdir(directory):
+            if file_name.endswith(".csv"):
+                signatures[file_name] = file_signature(os.path.join(directory, file_name))
+        for file_name in os.listdir(os.path.join(directory, "music_raw")):
+            if not file_name.endswith(PARTIAL_SUFFIX):
+                signatures[os.path.join("music_raw", file_name)] = True
+        return signatures
+
+    def status(self):
+        with self.lock:
+            return {
+                "queue_depth": len(self.pending),
+                "pending": sorted(self.pending),
+                "running": self.running,
+                "runs": self.runs,
+                "last_run": self.last_run,
+                "last_duration": self.last_duration,
+                "last_error": self.last_error,
+                "sheet_polls": self.poller.polls if self.poller else 0,
+                "sheet_last_poll": self.poller.last_poll if self.poller else None,
+                "sheet_last_error": self.poller.last_error if self.poller else None,
+            }
+
+    def serve_status(self):
+        import BaseHTTPServer
+
+        class StatusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = json.dumps(self.server.watcher.status(), indent=1, sort_keys=True)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", self.args.status_port), StatusHandler)
+        server.watcher = self
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        print ("Serving status on port", self.args.status_port)
+
+    def sheet_changed(self, indexes):
+        with self.lock:
+            if indexes is None or self.sheet_rows is None:
+                self.sheet_rows = None
+            else:
+                self.sheet_rows |= indexes
+            self.pending.add("input.csv")
+            self.changed_at = time.time()
+
+    def rebuild(self):
+        with self.lock:
+            print ("Rebuilding for changes in", sorted(self.pending))
+            model = None
+            if self.model and self.pending == set(["input.csv"]) and self.sheet_rows:
+                model = self.model
+                print ("Applying changed spreadsheet rows", sorted(self.sheet_rows))
+            rows = self.sheet_rows
+            self.pending = set()
+            self.sheet_rows = set()
+            self.running = True
+        began = time.time()
+        error = None
+        try:
+            self.model = build(self.args, model, rows)
+        except Exception:
+            # the model may be half updated, read everything again next time
+            self.model = None
+            error = traceback.format_exc()
+            print error
+        with self.lock:
+            self.running = False
+            self.runs += 1
+            self.last_run = datetime.datetime.now().isoformat()
+            self.last_duration = time.time() - began
+            self.last_error = error
+
+    def run(self):
+        self.serve_status()
+        if os.path.exists(os.path.join(directory, "key.txt")):
+            self.poller = SpreadsheetPoller(self.args.sheet_interval, self.sheet_changed)
+            self.poller.start()
+        snapshot = {}
+        while True:
+            now = time.time()
+            current = self.snapshot()
+            changed = set(name for name in set(snapshot) | set(current) if snapshot.get(name) != current.get(name))
+            snapshot = current
+            if changed:
+                with self.lock:
+                    self.pending |= changed
+                self.changed_at = now
+            if self.pending and now - self.changed_at >= self.args.debounce:
+                self.rebuild()
+                # the build itself writes into data/, don't treat its own outputs as new changes
+                snapshot = self.snapshot()
+            time.sleep(self.args.poll_interval)
+
+
 ############
 # WORKFLOW #
 ############
 
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Process music submissions for the competition")
+    parser.add_argument("command", nargs="?", default="build", choices=["build", "counts", "report"],
+                        help="build runs every stage, counts and report only print the counts or rewrite the "
+                             "reports from the model snapshot when it is current (default: build)")
+    parser.add_argument("--download-workers", type=int, default=8, help="number of concurrent downloads")
+    parser.add_argument("--downloads-per-host", type=int, default=4, help="concurrent downloads allowed per host")
+    parser.add_argument("--download-retries", type=int, default=3, help="retries for a failed download")
+    parser.add_argument("--transcode-workers", type=int, default=None,
+                        help="number of concurrent ffmpeg processes (default: number of CPUs)")
+    parser.add_argument("--normalize", action="store_true",
+                        help="trim leading and trailing silence and normalize loudness (EBU R128) when converting")
+    parser.add_argument("--prune", action="store_true", help="remove converted music that no longer belongs to a start")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only process starts and rewrite reports whose inputs changed since the last build")
+    parser.add_argument("--dry-run", action="store_true", help="print the incremental build plan without running it")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and rebuild incrementally whenever inputs in data/ change")
+    parser.add_argument("--poll-interval", type=float, default=5, help="seconds between checks for changes in watch mode")
+    parser.add_argument("--debounce", type=float, default=10,
+                        help="seconds without further changes before rebuilding in watch mode")
+    parser.add_argument("--sheet-interval", type=float, default=60,
+                        help="seconds between downloads of the live spreadsheet in watch mode")
+    parser.add_argument("--refresh-spreadsheet", action="store_true",
+                        help="download the live spreadsheet again if it changed instead of using data/input.csv")
+    parser.add_argument("--status-port", type=int, default=8080, help="local port for the watch mode status page")
+    parser.add_argument("--header-lengths", action="store_true",
+                        help="trust the mp3 header for music length instead of decoding each file once")
+    parser.add_argument("--length-tolerance", type=float, default=0,
+                        help="seconds a program may be under the minimum or over the maximum length")
+    parser.add_argument("--fingerprint", action="store_true",
+                        help="fingerprint converted music and warn about starts sharing music or resubmitting it")
+    parser.add_argument("--columnar", action="store_true",
+                        help="compute counts and report rosters from a column store over all starts")
+    parser.add_argument("--profile", metavar="PATH", help="write cProfile statistics of each build to PATH")
+    parser.add_argument("--report-formats", default="html",
+                        help="comma separated report formats to write: " + ", ".join(sorted(REPORT_FORMATS)))
+    parser.add_argument("--export", action="store_true",
+                        help="write running order playlists (M3U and JSON) for each event to data/export")
+    parser.add_argument("--bundle", action="store_true",
+                        help="with --export, also pack each event's playlist and music into an uncompressed zip")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="save the model in data/model_snapshot.pickle for the counts and report commands")
+    parser.add_argument("--workspace", type=os.path.abspath,
+                        help="build each competition in this directory, sharing raw and converted music in its store/")
+    parser.add_argument("--competition", action="append",
+                        help="with --workspace, only build this competition (may be given more than once)")
+    args = parser.parse_args(argv)
+    if args.competition and not args.workspace:
+        parser.error("--competition requires --workspace")
+    return args
+
+
+def download_spreadsheet(refresh=False):
+    # TODO use google sheets api
+    input_spreadsheet_path = os.path.join(directory, "input.csv")
+    if os.path.exists(input_spreadsheet_path) and not refresh:
+        print "Using cached spreadsheet"
+    else:
+        print "Downloading live spreadsheet"
+        SpreadsheetFetcher().fetch()
 
+
+def read_inputs():
     # read events
-    events = read_events()
-    events_by_name = {event.name: event for event in events}
+    with stats.stage("read_events"):
+        events = read_events()
+        event_names = EventNames(events)
 
     # read entries
-    skaters = read_entries(events_by_name)
-    read_updated_entries(skaters, events_by_name)
+    with stats.stage("read_entries"):
+        skaters = read_entries(event_names)
+        read_updated_entries(skaters, event_names)
 
-    # TODO use google sheets api
+    # read submissions
+    with stats.stage("read_submissions"):
+        read_submissions(skaters)
+    if not events:
+        input_errors.add_sheet(EVENTS_SCHEMA.name, "No events")
+    elif not any(event.starts for event in events):
+        input_errors.add_sheet(ENTRIES_SCHEMA.name, "No entries for any event")
+    input_errors.print_report()
+    input_errors.check_sheets()
+    return events, skaters
+
+
+def build_stages(args, model=None, rows=None):
     # Download Spreadsheet
-    input_spreadsheet_path = os.path.join(directory, "input.csv")
-    if os.path.exists(input_spreadsheet_path):
-        print "Using cached spreadsheet"
+    with stats.stage("download_spreadsheet"):
+        download_spreadsheet(args.refresh_spreadsheet)
+
+    report_formats = args.report_formats.split(",")
+    build_state = None
+    if args.incremental or args.dry_run:
+        build_state = BuildState()
+        changed_inputs = build_state.changed_inputs(report_formats)
+        if not changed_inputs:
+            print "Nothing to do"
+            return
+
+    if model:
+        events, skaters = model
+        with stats.stage("read_submissions"):
+            update_submissions(skaters, events, rows)
+        input_errors.print_report()
+        input_errors.check_sheets()
     else:
-        print "Downloading live spreadsheet"
-        key_path = os.path.join(directory, "key.txt")
-        with open(key_path, "r") as key_file:
-            spreadsheet_key = key_file.read().strip()
-        music_spreadsheet_url = "https://docs.google.com/spreadsheets/d/" + spreadsheet_key + "/export?format=csv"
-        urllib.urlretrieve(music_spreadsheet_url, input_spreadsheet_path)
+        events, skaters = read_inputs()
+    starts = [start for event in events for start in event.starts]
+    store = None
+    if args.workspace:
+        store = MusicStore(os.path.join(args.workspace, "store"))
+    library = MusicLibrary(args.normalize, store)
+    changed_starts = starts
+    if build_state:
+        with stats.stage("plan"):
+            changed_starts = build_state.changed_starts(starts, library)
+        stats.count("skipped_starts", len(starts) - len(changed_starts))
+        print_plan(changed_inputs, changed_starts)
+        if args.dry_run:
+            return
+
+    # download music files
+    with stats.stage("download"):
+        download_pool = DownloadPool(library.raw_index, args.download_workers, args.downloads_per_host,
+                                     args.download_retries)
+        download_pool.run(changed_starts)
+    stats.count("download_failures", len(download_pool.failures))
+
+    # convert music to mp3
+    with stats.stage("convert"):
+        transcode_pool = TranscodePool(library, args.transcode_workers)
+        transcode_pool.run(changed_starts)
+        if args.prune:
+            library.transcodes.prune(starts)
+    stats.count("transcode_failures", len(transcode_pool.failures()))
+
+    # read music length
+    with stats.stage("read_time"):
+        if not args.header_lengths:
+            measure_lengths(starts, library.metadata, args.transcode_workers)
+        for start in starts:
+            read_time(start, library.metadata)
+        library.save()
+
+    table = None
+    if args.columnar:
+        with stats.stage("columnar"):
+            table = StartTable(events)
+
+    with stats.stage("check_lengths"):
+        check_lengths(starts, args.length_tolerance, table)
+
+    if args.fingerprint:
+        with stats.stage("fingerprint"):
+            check_fingerprints(starts, library, args.transcode_workers)
+
+    print_counts(events, True, table)
+
+    with stats.stage("reports"):
+        # the template and the formats change every report, not only those of events whose rows changed
+        if build_state:
+            changed_events = build_state.changed_events(events)
+            print ("Events to update", [event.name for event in changed_events])
+        if (not build_state or changed_events or "template.html" in changed_inputs or
+                "report_formats" in changed_inputs):
+            generate_reports(events, report_formats, table)
+
+    if args.export:
+        with stats.stage("export"):
+            export_events(events, library.metadata, args.bundle, table)
+            library.metadata.save()
+
+    if args.snapshot:
+        with stats.stage("snapshot"):
+            ModelSnapshot().save(events)
+
+    if build_state:
+        failed_starts = set(start for start, url, error in download_pool.failures)
+        failed_starts.update(transcode.start for transcode in transcode_pool.failures())
+        build_state.update(starts, events, library, failed_starts, report_formats)
+        build_state.save()
+    return events, skaters
+
+
+def build(args, model=None, rows=None):
+    # model and rows let watch mode apply only the changed rows of input.csv to the model of its last build
+    stats.reset()
+    input_errors.reset()
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        return build_stages(args, model, rows)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        stats.save(os.path.join(directory, "run_report.json"))
+        stats.print_summary()
+
+
+def load_model(args):
+    # the snapshot of the last build if it is current, otherwise the spreadsheets and cached music lengths
+    snapshot = ModelSnapshot()
+    events = snapshot.load()
+    if events is None:
+        print "Reading inputs, the model snapshot is missing or out of date"
+        events, _ = read_inputs()
+        metadata = MetadataCache()
+        for start in [start for event in events for start in event.starts]:
+            read_time(start, metadata)
+        metadata.save()
+        if args.snapshot:
+            snapshot.save(events)
+    # length statuses depend on --length-tolerance, which may differ from the build that saved the snapshot
+    check_lengths([start for event in events for start in event.starts], args.length_tolerance)
+    return events
 
-    # read submissions
-    read_submissions(skaters)
 
-    for event in events:
-        for start in event.starts:
-            # download music files
-            download_music(start)
-            # convert music to mp3
-            convert_music(start)
-            # read music length
-            read_time(start)
-
-    print_counts(events, True)
-
-    generate_report(events, True)
-    generate_report(events, False)
+def run_command(args):
+    input_errors.reset()
+    events = load_model(args)
+    table = StartTable(events) if args.columnar else None
+    if args.command == "counts":
+        print_counts(events, True, table)
+    elif args.command == "report":
+        generate_reports(events, args.report_formats.split(","), table)
+
+
+def run(args):
+    try:
+        if args.command == "build":
+            build(args)
+        else:
+            run_command(args)
+    except InputSheetError as e:
+        raise SystemExit(str(e))
+
+
+def main():
+    args = parse_args()
+    if args.workspace:
+        competitions = args.competition or competition_directories(args.workspace)
+        if args.watch:
+            if len(competitions) != 1:
+                raise SystemExit("Watch mode needs exactly one --competition in a workspace")
+            use_competition(os.path.join(args.workspace, competitions[0]))
+            Watcher(args).run()
+            return
+        for competition in competitions:
+            print ("Competition", competition)
+            use_competition(os.path.join(args.workspace, competition))
+            run(args)
+    elif args.watch:
+        Watcher(args).run()
+    else:
+        run(args)
 
 
 if __name__ == "__main__":